@@ -0,0 +1,230 @@
+"""Compare float32 and packed ternary BitNet inference on CPU.
+
+Each weight format is loaded in its own child process so resident memory is
+measured from a clean start. Reports load time, RSS, weight bytes, prefill
+time and greedy decode tokens/s, and checks that both formats pick the same
+tokens. --tiny builds a small randomly initialised BitNet whose linear weights
+are already ternary, so the two formats should agree exactly:
+
+    python bench.py --tiny
+    python bench.py --model microsoft/bitnet-b1.58-2B-4T-bf16 --new-tokens 64
+
+--speculative N decodes a second time with prompt lookup drafts of up to N
+tokens and reports the acceptance rate and tokens/s against plain decoding.
+Pass --prompt with text that the reply will quote, such as an edit request:
+
+    python bench.py --formats ternary --speculative 8 --prompt "$(cat request.txt)"
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+FORMATS = ("float32", "ternary")
+
+def read_rss():
+    # Resident set size of this process in bytes (Linux only)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def make_tiny_model(path, seed):
+    import torch
+    import torch.nn as nn
+    from transformers import BitNetConfig, BitNetForCausalLM
+    import ternary
+
+    torch.manual_seed(seed)
+    config = BitNetConfig(vocab_size=1024, hidden_size=256, intermediate_size=704, num_hidden_layers=4,
+                          num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=1024)
+    model = BitNetForCausalLM(config)
+    with torch.no_grad():
+        # Snap linear weights to scale * {-1, 0, 1} like a quantized BitNet, so both formats compute the same function
+        for name, module in model.named_modules():
+            if isinstance(module, nn.Linear) and not name.endswith("lm_head"):
+                values, scale = ternary.quantize(module.weight)
+                module.weight.copy_(values.float() * scale.to(torch.bfloat16).float())
+        # The ternary path loads at bfloat16, so keep every weight exactly representable there
+        for parameter in model.parameters():
+            parameter.copy_(parameter.to(torch.bfloat16).float())
+    model.save_pretrained(path)
+
+def run(options):
+    import torch
+    import server
+
+    if options["threads"]:
+        torch.set_num_threads(options["threads"])
+    started = time.perf_counter()
+    model = server.load_model(options["model"], options["format"])
+    model.eval()
+    load_time = time.perf_counter() - started
+    rss = read_rss()
+
+    if options["prompt"]:
+        from transformers import AutoTokenizer
+        input_ids = AutoTokenizer.from_pretrained(options["model"])(options["prompt"], return_tensors="pt")["input_ids"]
+    else:
+        generator = torch.Generator().manual_seed(options["seed"])
+        input_ids = torch.randint(0, model.config.vocab_size, (1, options["prompt_tokens"]), generator=generator)
+    tokens = []
+    with torch.inference_mode():
+        started = time.perf_counter()
+        outputs = model(input_ids=input_ids, use_cache=True)
+        prefill_time = time.perf_counter() - started
+        first_logits = outputs.logits[0, -1].float()
+
+        started = time.perf_counter()
+        for _ in range(options["new_tokens"]):
+            next_token = outputs.logits[:, -1].argmax(-1)
+            tokens.append(int(next_token))
+            outputs = model(input_ids=next_token.unsqueeze(1), past_key_values=outputs.past_key_values, use_cache=True)
+        decode_time = time.perf_counter() - started
+        speculative = speculative_decode(model, input_ids, options) if options["speculative"] else {}
+
+    import ternary
+    print(json.dumps({
+        "format": options["format"],
+        "load_seconds": load_time,
+        "rss_bytes": rss,
+        "weight_bytes": ternary.weight_bytes(model),
+        "prefill_seconds": prefill_time,
+        "decode_tokens_per_second": options["new_tokens"] / decode_time if decode_time > 0 else None,
+        "tokens": tokens,
+        # Small vocabularies only, for a logit-level comparison between formats
+        "first_logits": first_logits.tolist() if first_logits.numel() <= 4096 else None,
+        **speculative,
+    }))
+
+def speculative_decode(model, input_ids, options):
+    # Greedy decoding again, checking prompt lookup drafts with the server's verify_draft
+    import torch
+    import server
+
+    outputs = model(input_ids=input_ids, use_cache=True)
+    past = server.cache_to_tensors(outputs.past_key_values)
+    lookup = server.PromptLookup()
+    lookup.extend(input_ids[0].tolist())
+    tokens = [int(outputs.logits[0, -1].argmax())]
+    drafted = accepted = steps = 0
+    started = time.perf_counter()
+    # The plain loop's forward passes yield one token past the ones it records, so stop at the same point
+    while len(tokens) <= options["new_tokens"]:
+        lookup.extend(tokens[len(lookup.tokens) - input_ids.shape[1]:])
+        draft = lookup.draft(min(options["speculative"], options["new_tokens"] - len(tokens)))
+        length = past[0][0].shape[2]
+        outputs = model(input_ids=torch.tensor([[tokens[-1]] + draft]), past_key_values=server.tensors_to_cache(past),
+                        use_cache=True)
+        count, token = server.verify_draft(outputs.logits[0], draft, temperature=0)
+        # Drop the keys/values of rejected drafts
+        past = tuple((key[:, :, :length + 1 + count], value[:, :, :length + 1 + count])
+                     for key, value in server.cache_to_tensors(outputs.past_key_values))
+        tokens.extend(draft[:count] + [token])
+        drafted += len(draft)
+        accepted += count
+        steps += 1
+    decode_time = time.perf_counter() - started
+    return {
+        "speculative_tokens_per_second": options["new_tokens"] / decode_time if decode_time > 0 else None,
+        "speculative_steps": steps,
+        "acceptance_rate": accepted / drafted if drafted else None,
+        "speculative_tokens": tokens[:options["new_tokens"]],
+    }
+
+def run_child(options):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", json.dumps(options)],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"{options['format']} run failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def report(results):
+    rows = [("load (s)", "load_seconds", "{:.2f}"), ("RSS (MiB)", "rss_bytes", "{:.0f}"),
+            ("weights (MiB)", "weight_bytes", "{:.1f}"), ("prefill (s)", "prefill_seconds", "{:.3f}"),
+            ("decode tok/s", "decode_tokens_per_second", "{:.2f}")]
+    if any("speculative_tokens_per_second" in result for result in results):
+        rows += [("lookup tok/s", "speculative_tokens_per_second", "{:.2f}"),
+                 ("acceptance", "acceptance_rate", "{:.1%}")]
+    print(f"{'':16}" + "".join(f"{result['format']:>12}" for result in results))
+    for label, key, fmt in rows:
+        cells = []
+        for result in results:
+            value = result.get(key)
+            if value is not None and key.endswith("bytes"):
+                value /= 2**20
+            cells.append(f"{fmt.format(value) if value is not None else '-':>12}")
+        print(f"{label:16}" + "".join(cells))
+
+    for result in results:
+        if result.get("speculative_tokens_per_second") and result.get("decode_tokens_per_second"):
+            same = sum(a == b for a, b in zip(result["tokens"], result["speculative_tokens"]))
+            print(f"{result['format']} speculative: {result['speculative_tokens_per_second'] / result['decode_tokens_per_second']:.2f}x "
+                  f"tokens/s in {result['speculative_steps']} steps, {same}/{len(result['tokens'])} tokens as plain greedy")
+
+    if len(results) == 2:
+        base, other = results
+        matching = sum(a == b for a, b in zip(base["tokens"], other["tokens"]))
+        print(f"greedy tokens matching: {matching}/{len(base['tokens'])}")
+        if base["first_logits"] and other["first_logits"]:
+            diff = max(abs(a - b) for a, b in zip(base["first_logits"], other["first_logits"]))
+            print(f"max prefill logit difference: {diff:.2e}")
+        for key in ("rss_bytes", "weight_bytes", "decode_tokens_per_second"):
+            if base.get(key) and other.get(key):
+                print(f"{key}: {other[key] / base[key]:.2f}x of float32")
+        if other.get("decode_tokens_per_second") and base.get("decode_tokens_per_second") and \
+                other["decode_tokens_per_second"] < base["decode_tokens_per_second"]:
+            print("ternary trades speed for memory: its weights are unpacked to floats on every forward pass")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", help="checkpoint name or path (default: the server's MODEL_NAME)")
+    parser.add_argument("--tiny", action="store_true", help="use a small random BitNet with ternary weights instead")
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=FORMATS)
+    parser.add_argument("--prompt-tokens", type=int, default=128)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps torch's default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prompt", help="prompt text instead of --prompt-tokens random token ids")
+    parser.add_argument("--speculative", type=int, default=0, metavar="N",
+                        help="also decode with prompt lookup drafts of up to N tokens")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(json.loads(args.run))
+        return
+    if args.tiny and args.prompt:
+        parser.error("--tiny has no tokenizer, use --prompt-tokens with it")
+
+    with tempfile.TemporaryDirectory(prefix="bitnet-bench-") as tiny_dir:
+        model = args.model
+        if args.tiny:
+            make_tiny_model(tiny_dir, args.seed)
+            model = tiny_dir
+        elif model is None:
+            import server
+            model = server.MODEL_NAME
+
+        results = []
+        for weight_format in args.formats:
+            options = {"model": model, "format": weight_format, "prompt_tokens": args.prompt_tokens,
+                       "new_tokens": args.new_tokens, "threads": args.threads, "seed": args.seed,
+                       "prompt": args.prompt, "speculative": args.speculative}
+            results.append(run_child(options))
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
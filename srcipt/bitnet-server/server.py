@@ -1,63 +1,985 @@
 import os
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import glob
+import queue
+import struct
+import itertools
+import contextlib
+import multiprocessing
+from collections import OrderedDict
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import unquote, parse_qs
 import json
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from safetensors.torch import save_model as save_safetensors
 import torch
+import torch.nn.functional as F
+import ternary
+
+try:
+    from transformers.modeling_utils import no_init_weights
+except ImportError:
+    no_init_weights = contextlib.nullcontext
 
 # Disable compiler requirements
 os.environ['TORCHDYNAMO_DISABLE'] = '1'
 
 PORT = 1234
 MODEL_NAME = "microsoft/bitnet-b1.58-2B-4T"
+# "float32", or "ternary" to keep linear weights packed at 2 bits (pair it with the -bf16 checkpoint,
+# the default one ships its own packed layers). Ternary trades speed for memory: linear weights take 16x less
+# memory, but every forward pass unpacks them to floats again, so decoding is slower than float32.
+# Use it when the model wouldn't otherwise fit, not to make replies faster (bench.py measures both)
+WEIGHT_FORMAT = "float32"
 MODEL_PARAMS = {
     "temperature": 0.7,
     "max_new_tokens": 512,
     "top_p": 0.9,
 }
+KEEP_ALIVE_TIMEOUT = 5
+KEEP_ALIVE_MAX_REQUESTS = 100
+MAX_QUEUED_CHATS = 64  # Chats waiting for the model beyond this get a 503
+MAX_BATCH_SIZE = 8  # Sequences decoded together in one forward pass
+BATCH_WAIT = 0.01  # When idle, wait this long (sec) for more chats to prefill together with the first
+MAX_GENERATION_TIME = 120  # Wall-clock limit per chat (sec), requests may ask for less with "timeout"
+MAX_STOP_SEQUENCES = 4
+PREFIX_CACHE_BYTES = 512 * 1024 * 1024  # Memory for keys/values of recent prompts, 0 turns prefix reuse off
+PREFIX_CACHE_MIN_TOKENS = 32  # Shorter prefixes aren't worth keeping
+# Prompt lookup speculative decoding: draft up to this many tokens per step by finding the latest n-gram
+# in the prompt (or reply) that matches the end of the text, then check them all in one forward pass. 0 turns it off
+SPECULATIVE_TOKENS = 0
+PROMPT_LOOKUP_NGRAM = 3  # Longest n-gram to match, shorter ones are tried down to a single token
+WARMUP_PROMPT = "Hello"
+REPLICAS = 1  # Model processes, each pinned to its own cores; 1 serves from this process
+THREADS_PER_REPLICA = 0  # torch threads per replica, 0 uses one per core it is pinned to
+REPLICA_ACCEPT_TIMEOUT = 10  # Chats a replica hasn't taken within this long (sec) get a 503
+# Replicas map their weights from here, a multi-GB file per model and format kept in the user's cache directory
+# like the Hugging Face downloads; delete the file after changing MODEL_NAME's checkpoint
+WEIGHTS_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                                 "piton", "bitnet-weights")
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+def load_model(name, weight_format=WEIGHT_FORMAT):
+    if weight_format == "float32":
+        return AutoModelForCausalLM.from_pretrained(
+            name,
+            torch_dtype=torch.float32,  # Use float32 for CPU
+            low_cpu_mem_usage=True
+        )
+    if weight_format == "ternary":
+        # Load at half width to keep the peak down; packing brings linear layers to 2 bits per weight
+        model = AutoModelForCausalLM.from_pretrained(name, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+        packed = ternary.pack_model(model, torch.float32)
+        print(f"Packed {packed} linear layers to ternary, weights now take {ternary.weight_bytes(model) / 2**20:.0f} MiB")
+        return model
+    raise ValueError(f"Unknown weight format: {weight_format}")
+
+def can_map_weights(name):
+    # Checkpoints that ship their own quantized layers (like the default BitNet one) don't rebuild from the config alone
+    return getattr(AutoConfig.from_pretrained(name), 'quantization_config', None) is None
+
+def export_weights(name, weight_format, directory=WEIGHTS_CACHE_DIR):
+    # Load the model once and save it in its serving format, for replicas to map instead of each loading a copy
+    path = os.path.join(directory, f"{name.strip('/').replace('/', '--')}-{weight_format}.safetensors")
+    if not os.path.exists(path):
+        print(f"Exporting {weight_format} weights to {path}...")
+        model = load_model(name, weight_format)
+        os.makedirs(directory, exist_ok=True)
+        # save_model drops tied duplicates (lm_head sharing the embeddings), tie_weights restores them
+        save_safetensors(model, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        del model
+    return path
+
+def mmap_safetensors(path):
+    """Tensors of a safetensors file as views into one private memory map of it.
+
+    The pages come from the page cache, so every process mapping the same file
+    shares one copy of the weights until something writes to them.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    size = os.path.getsize(path)
+    # shared=False maps the file copy-on-write, so the file itself is never modified
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=size)
+    data = torch.empty(0, dtype=torch.uint8).set_(storage, 0, (size,))
+    start_of_data = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        start, end = info["data_offsets"]
+        # safetensors pads the header so every tensor is aligned for a zero-copy dtype view
+        tensors[name] = data[start_of_data + start:start_of_data + end].view(SAFETENSORS_DTYPES[info["dtype"]]).view(info["shape"])
+    return tensors
+
+def load_mapped_model(name, weight_format, path):
+    """Build the model around weights mapped from an export_weights file, or None if its layout doesn't match"""
+    config = AutoConfig.from_pretrained(name)
+    # Parameters are replaced by the mapped tensors, so skip initialising them (untouched pages cost no memory)
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32)
+    if weight_format == "ternary":
+        ternary.pack_model(model, torch.float32, empty=True)
+    tensors = mmap_safetensors(path)
+    expected = model.state_dict()
+    tied = set(getattr(model, '_tied_weights_keys', None) or [])
+    # load_state_dict raises on a shape mismatch even with strict=False, so compare everything first
+    if set(tensors) - set(expected) or set(expected) - set(tensors) - tied:
+        return None
+    if any(tensor.shape != expected[key].shape or tensor.dtype != expected[key].dtype for key, tensor in tensors.items()):
+        return None
+    model.load_state_dict(tensors, strict=False, assign=True)
+    model.tie_weights()
+    model.eval()
+    return model
 
 class AIClient:
-    def __init__(self):
+    def __init__(self, weights_path=None):
         print(f"Loading model {MODEL_NAME}...")
         try:
             # Disable torch compile which requires a compiler
             torch._dynamo.config.suppress_errors = True
             self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                MODEL_NAME,
-                torch_dtype=torch.float32,  # Use float32 for CPU
-                low_cpu_mem_usage=True
-            )
+            self.model = None
+            if weights_path is not None:
+                self.model = load_mapped_model(MODEL_NAME, WEIGHT_FORMAT, weights_path)
+                if self.model is None:
+                    print("Exported weights don't match the model's layers, loading a private copy instead")
+            if self.model is None:
+                self.model = load_model(MODEL_NAME, WEIGHT_FORMAT)
             print("Model loaded successfully")
         except Exception as e:
             print(f"Failed to load model: {str(e)}")
             raise
+    
+    def warm_up(self):
+        # One short generation touches every weight and spins up torch's thread pool before real traffic
+        inputs = self.tokenizer(WARMUP_PROMPT, return_tensors="pt")
+        with torch.no_grad():
+            self.model.generate(**inputs, max_new_tokens=1)
+        print("Model warmed up")
         
-    def get_response(self, user_message: str) -> str:
-        if not user_message.strip():
-            return "Please provide a valid question or prompt."
+
+def cache_to_tensors(cache):
+    """Per-layer (key, value) tensors of shape [batch, heads, seq, head_dim] from any cache format"""
+    if isinstance(cache, (tuple, list)):
+        return tuple((layer[0], layer[1]) for layer in cache)
+    if hasattr(cache, 'to_legacy_cache'):
+        return cache.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in cache.layers)
+
+def tensors_to_cache(past):
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past)
+    return DynamicCache(past)
+
+def sample_tokens(logits, temperature=MODEL_PARAMS["temperature"], top_p=MODEL_PARAMS["top_p"]):
+    """Pick one token per row with temperature and nucleus (top-p) sampling"""
+    if temperature <= 0:
+        return logits.argmax(-1)
+    return torch.multinomial(token_probs(logits, temperature, top_p), 1).squeeze(-1)
+
+def token_probs(logits, temperature=MODEL_PARAMS["temperature"], top_p=MODEL_PARAMS["top_p"]):
+    """The distribution sample_tokens draws from, normalised over the last dimension"""
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+    # Keep the smallest set of tokens whose probability reaches top_p
+    sorted_probs[sorted_probs.cumsum(dim=-1) - sorted_probs > top_p] = 0
+    probs = torch.zeros_like(probs).scatter_(-1, sorted_ids, sorted_probs)
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+def verify_draft(logits, draft, temperature=MODEL_PARAMS["temperature"], top_p=MODEL_PARAMS["top_p"]):
+    """Check drafted tokens against the model's predictions, returning (tokens accepted, token that follows them).
+
+    logits[i] is the prediction after the i-th fed token, the first being the one
+    before the draft. Greedy decoding keeps drafts that match the argmax. Sampling
+    accepts each draft with the probability the model gives it and otherwise draws
+    from the remaining probability, which leaves the output distribution unchanged.
+    """
+    if temperature <= 0:
+        predicted = logits.argmax(-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+            accepted += 1
+        return accepted, predicted[accepted]
+    probs = token_probs(logits[:len(draft) + 1], temperature, top_p)
+    for index, token in enumerate(draft):
+        if float(torch.rand(())) >= float(probs[index, token]):
+            rejected = probs[index].clone()
+            rejected[token] = 0
+            return index, int(torch.multinomial(rejected, 1))
+    return len(draft), int(torch.multinomial(probs[len(draft)], 1))
+
+def past_bytes(past):
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in past)
+
+class PrefixCache:
+    """LRU of past keys/values for recent token sequences, so prompts sharing a prefix skip that part of prefill"""
+    def __init__(self, max_bytes=PREFIX_CACHE_BYTES, min_tokens=PREFIX_CACHE_MIN_TOKENS):
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens
+        self.entries = OrderedDict()  # token ids -> per-layer (key, value) of shape [1, heads, len, head_dim]
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+    
+    @staticmethod
+    def _common_length(a, b):
+        length = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            length += 1
+        return length
+    
+    def lookup(self, token_ids):
+        """Longest cached prefix of token_ids as (length, past), leaving at least one token to prefill"""
+        best, best_key = 0, None
+        for key in self.entries:
+            length = min(self._common_length(key, token_ids), len(token_ids) - 1)
+            if length > best:
+                best, best_key = length, key
+        if best < self.min_tokens:
+            self.misses += 1
+            return 0, None
+        self.entries.move_to_end(best_key)
+        self.hits += 1
+        self.reused_tokens += best
+        # Attention is causal, so the first `best` positions of a longer entry are exactly the prefix's keys/values
+        return best, tuple((key[:, :, :best], value[:, :, :best]) for key, value in self.entries[best_key])
+    
+    def store(self, token_ids, past):
+        """Keep keys/values (already copied out of the batch) for token_ids, evicting least recently used entries"""
+        token_ids = tuple(token_ids)
+        size = past_bytes(past)
+        if len(token_ids) < self.min_tokens or size > self.max_bytes:
+            return
+        for key in list(self.entries):
+            if key[:len(token_ids)] == token_ids:
+                # An entry that extends this one already covers it
+                self.entries.move_to_end(key)
+                return
+            if token_ids[:len(key)] == key:
+                self.bytes -= past_bytes(self.entries.pop(key))
+        self.entries[token_ids] = past
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= past_bytes(evicted)
+    
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits,
+                "misses": self.misses, "reused_tokens": self.reused_tokens}
+
+class PromptLookup:
+    """N-gram index over a sequence's tokens, for drafting a continuation of text it has already seen"""
+    def __init__(self, max_ngram=PROMPT_LOOKUP_NGRAM):
+        self.max_ngram = max_ngram
+        self.tokens = []
+        self.positions = {}  # n-gram -> index right after its latest occurrence
+    
+    def extend(self, tokens):
+        for token in tokens:
+            # Index the n-grams ending at the current last token now that something follows them, so
+            # drafting never matches the tail of the text with itself
+            end = len(self.tokens)
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self.positions[tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token)
+    
+    def draft(self, count):
+        """Up to count tokens that followed the longest earlier match of the text's last n-gram"""
+        if count <= 0:
+            return []
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            start = self.positions.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + count]
+        return []
+
+class Sequence:
+    """One chat being generated: its stopping rules, the text decoded so far and where it is delivered"""
+    def __init__(self, prompt_ids, max_new_tokens=MODEL_PARAMS["max_new_tokens"], stop=(), deadline=None, stream=False,
+                 events=None):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.stop = [text for text in stop if text]
+        self.deadline = deadline
+        self.future = Future()
+        # Streaming requests also get ("delta", text) and then ("done", reason) or ("error", message) events,
+        # put on a queue here unless the caller passes its own object with a put method
+        self.events = events if events is not None else (queue.Queue() if stream else None)
+        self.cancelled = False
+        self.generated = []
+        self.text = ""
+        self.sent = 0
+        # Only the tokens from prefix_offset on are re-decoded for each new token
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.lookup = None  # PromptLookup, when the scheduler decodes speculatively
+    
+    def cancel(self):
+        # Checked by the scheduler after the next decode step
+        self.cancelled = True
+    
+    def add_token(self, token, tokenizer):
+        """Decode just the new token and return the text that can be sent, or None once a stop sequence shows up"""
+        self.generated.append(token)
+        prefix = tokenizer.decode(self.generated[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        text = tokenizer.decode(self.generated[self.prefix_offset:], skip_special_tokens=True)
+        # A trailing replacement character means a multi-byte character isn't complete yet
+        if len(text) > len(prefix) and not text.endswith("\ufffd"):
+            self.text += text[len(prefix):]
+            self.prefix_offset, self.read_offset = self.read_offset, len(self.generated)
         
+        for stop in self.stop:
+            index = self.text.find(stop, max(0, self.sent - len(stop) + 1))
+            if index != -1:
+                self.text = self.text[:index]
+                return None
+        # Hold back a tail that could still turn into a stop sequence
+        held = max((size for stop in self.stop for size in range(len(stop) - 1, 0, -1) if self.text.endswith(stop[:size])), default=0)
+        delta = self.text[self.sent:len(self.text) - held]
+        self.sent += len(delta)
+        return delta
+    
+    def finish(self, reason):
+        if self.events is not None:
+            if self.sent < len(self.text):
+                self.events.put(("delta", self.text[self.sent:]))
+            self.events.put(("done", reason))
+        self.future.set_result((self.text.strip(), reason))
+    
+    def fail(self, error):
+        if self.future.done():
+            return
+        if self.events is not None:
+            self.events.put(("error", str(error)))
+        self.future.set_exception(error)
+
+class BatchScheduler:
+    """Continuous batching: sequences join the running batch after a left-padded prefill and leave as soon as they finish"""
+    def __init__(self, ai_client, max_batch_size=MAX_BATCH_SIZE, batch_wait=BATCH_WAIT, prefix_cache_bytes=PREFIX_CACHE_BYTES,
+                 speculative_tokens=SPECULATIVE_TOKENS):
+        self.tokenizer = ai_client.tokenizer
+        self.model = ai_client.model
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        self.speculative_tokens = speculative_tokens
+        self.pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        eos = self.model.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos]) | {self.tokenizer.eos_token_id}
+        self.eos_ids.discard(None)
+        # Running batch: one row per sequence, keys/values left-padded to a common length
+        self.sequences = []
+        self.past = None
+        self.attention_mask = None
+        self.next_tokens = None
+        # Decoding counters for /api/ready
+        self.decode_steps = 0
+        self.decoded_tokens = 0
+        self.decode_seconds = 0.0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+    
+    def stats(self):
+        decoding = {"steps": self.decode_steps, "tokens": self.decoded_tokens,
+                    "tokens_per_second": self.decoded_tokens / self.decode_seconds if self.decode_seconds else None,
+                    "speculative_tokens": self.speculative_tokens}
+        if self.speculative_tokens:
+            decoding.update(drafted=self.drafted_tokens, accepted=self.accepted_tokens,
+                            acceptance_rate=self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else None)
+        data = {"decoding": decoding}
+        if self.prefix_cache is not None:
+            data["prefix_cache"] = self.prefix_cache.stats()
+        return data
+    
+    def run(self, jobs):
+        while True:
+            new = self._take_jobs(jobs, block=not self.sequences)
+            try:
+                with torch.inference_mode():
+                    if new:
+                        self._join(new)
+                    if self.sequences:
+                        self._decode_step()
+            except Exception as e:
+                print(f"AI Error: {str(e)}")
+                for sequence in self.sequences + new:
+                    sequence.fail(e)
+                self.sequences, self.past, self.attention_mask, self.next_tokens = [], None, None, None
+    
+    def _take_jobs(self, jobs, block):
+        """Pull waiting chats into free batch slots, lingering briefly when idle so a burst prefills together"""
+        new = []
+        deadline = None
+        while len(self.sequences) + len(new) < self.max_batch_size:
+            try:
+                if block and not new:
+                    sequence = jobs.get()
+                    deadline = time.monotonic() + self.batch_wait
+                elif deadline is not None:
+                    sequence = jobs.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    sequence = jobs.get_nowait()
+            except queue.Empty:
+                break
+            if sequence.cancelled:
+                sequence.finish("cancelled")
+            elif sequence.deadline is not None and time.monotonic() >= sequence.deadline:
+                sequence.finish("deadline")
+            else:
+                new.append(sequence)
+        return new
+    
+    def _join(self, new):
+        """Prefill the new sequences and merge them into the running batch"""
+        groups = []
+        misses = []
+        for sequence in new:
+            reused, past = self.prefix_cache.lookup(sequence.prompt_ids) if self.prefix_cache is not None else (0, None)
+            if reused:
+                groups.append(([sequence],) + self._prefill_from_prefix(sequence, reused, past))
+            else:
+                misses.append(sequence)
+        if misses:
+            groups.append((misses,) + self._prefill(misses))
+        
+        if self.speculative_tokens:
+            for sequence in new:
+                sequence.lookup = PromptLookup()
+                sequence.lookup.extend(sequence.prompt_ids)
+        for sequences, past, attention_mask, next_tokens in groups:
+            if self.sequences:
+                past, attention_mask = self._merge(self.past, self.attention_mask, past, attention_mask)
+                next_tokens = torch.cat([self.next_tokens, next_tokens])
+            self.sequences = self.sequences + sequences
+            self.past, self.attention_mask, self.next_tokens = past, attention_mask, next_tokens
+            self._record(range(len(self.sequences) - len(sequences), len(self.sequences)))
+    
+    def _prefill(self, sequences):
+        """Run the prompts as one left-padded batch, returning its keys/values, mask and first sampled tokens"""
+        length = max(len(sequence.prompt_ids) for sequence in sequences)
+        input_ids = torch.full((len(sequences), length), self.pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), length), dtype=torch.long)
+        for row, sequence in enumerate(sequences):
+            input_ids[row, length - len(sequence.prompt_ids):] = torch.tensor(sequence.prompt_ids)
+            attention_mask[row, length - len(sequence.prompt_ids):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        past = cache_to_tensors(outputs.past_key_values)
+        if self.prefix_cache is not None:
+            for row, sequence in enumerate(sequences):
+                start = length - len(sequence.prompt_ids)
+                self.prefix_cache.store(sequence.prompt_ids, tuple((key[row:row + 1, :, start:].clone(), value[row:row + 1, :, start:].clone())
+                                                                   for key, value in past))
+        return past, attention_mask, sample_tokens(outputs.logits[:, -1, :])
+    
+    def _prefill_from_prefix(self, sequence, reused, prefix_past):
+        """Prefill only the part of the prompt after a cached prefix"""
+        prompt_length = len(sequence.prompt_ids)
+        input_ids = torch.tensor([sequence.prompt_ids[reused:]])
+        attention_mask = torch.ones((1, prompt_length), dtype=torch.long)
+        position_ids = torch.arange(reused, prompt_length).unsqueeze(0)
+        # The cache appends by concatenation, so the stored prefix tensors are never modified
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=tensors_to_cache(prefix_past), use_cache=True)
+        past = cache_to_tensors(outputs.past_key_values)
+        self.prefix_cache.store(sequence.prompt_ids, tuple((key.clone(), value.clone()) for key, value in past))
+        return past, attention_mask, sample_tokens(outputs.logits[:, -1, :])
+    
+    @staticmethod
+    def _merge(past_a, mask_a, past_b, mask_b):
+        """Stack two batches, left-padding the shorter one's keys/values and mask"""
+        length = max(mask_a.shape[1], mask_b.shape[1])
+        pad_a, pad_b = length - mask_a.shape[1], length - mask_b.shape[1]
+        past = tuple(
+            (torch.cat([F.pad(key_a, (0, 0, pad_a, 0)), F.pad(key_b, (0, 0, pad_b, 0))]),
+             torch.cat([F.pad(value_a, (0, 0, pad_a, 0)), F.pad(value_b, (0, 0, pad_b, 0))]))
+            for (key_a, value_a), (key_b, value_b) in zip(past_a, past_b)
+        )
+        return past, torch.cat([F.pad(mask_a, (pad_a, 0)), F.pad(mask_b, (pad_b, 0))])
+    
+    def _decode_step(self):
+        started = time.perf_counter()
+        drafts = [self._draft(sequence) for sequence in self.sequences] if self.speculative_tokens else None
+        if drafts and any(drafts):
+            tokens = self._speculative_step(drafts)
+        else:
+            tokens = self._single_step()
+        self.decode_steps += 1
+        self.decoded_tokens += tokens
+        self.decode_seconds += time.perf_counter() - started
+    
+    def _draft(self, sequence):
+        # The lookup catches up with the reply so far, whose last token is the one about to be fed
+        sequence.lookup.extend(sequence.generated[len(sequence.lookup.tokens) - len(sequence.prompt_ids):])
+        # The step also yields one token after the accepted drafts, so leave room for it
+        return sequence.lookup.draft(min(self.speculative_tokens, sequence.max_new_tokens - len(sequence.generated) - 1))
+    
+    def _single_step(self):
+        """Feed every row its last token and sample the next one"""
+        attention_mask = torch.cat([self.attention_mask, torch.ones((len(self.sequences), 1), dtype=torch.long)], dim=1)
+        position_ids = attention_mask.sum(dim=1, keepdim=True) - 1
+        outputs = self.model(input_ids=self.next_tokens.unsqueeze(1), attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=tensors_to_cache(self.past), use_cache=True)
+        self.past = cache_to_tensors(outputs.past_key_values)
+        self.attention_mask = attention_mask
+        self.next_tokens = sample_tokens(outputs.logits[:, -1, :])
+        return self._record(range(len(self.sequences)))
+    
+    def _speculative_step(self, drafts):
+        """Feed every row its last token followed by its draft, keeping the drafts the model agrees with"""
+        rows = len(self.sequences)
+        width = 1 + max(len(draft) for draft in drafts)
+        input_ids = torch.full((rows, width), self.pad_id, dtype=torch.long)
+        new_mask = torch.zeros((rows, width), dtype=torch.long)
+        for row, draft in enumerate(drafts):
+            input_ids[row, :1 + len(draft)] = torch.tensor([int(self.next_tokens[row])] + draft)
+            new_mask[row, :1 + len(draft)] = 1
+        # Rows with shorter drafts are padded on the right, masked out like the left padding
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True) + torch.arange(width).unsqueeze(0)
+        outputs = self.model(input_ids=input_ids, attention_mask=torch.cat([self.attention_mask, new_mask], dim=1),
+                             position_ids=position_ids, past_key_values=tensors_to_cache(self.past), use_cache=True)
+        self.past = cache_to_tensors(outputs.past_key_values)
+        
+        accepted = {}
+        next_tokens = []
+        for row, draft in enumerate(drafts):
+            count, token = verify_draft(outputs.logits[row, :1 + len(draft)], draft)
+            # Keys/values of rejected drafts stay in the cache as masked-out holes until _compact
+            new_mask[row, 1 + count:] = 0
+            accepted[row] = draft[:count]
+            next_tokens.append(token)
+            self.drafted_tokens += len(draft)
+            self.accepted_tokens += count
+        self.attention_mask = torch.cat([self.attention_mask, new_mask], dim=1)
+        self.next_tokens = torch.tensor(next_tokens, dtype=torch.long)
+        tokens = self._record(range(rows), accepted)
+        self._compact()
+        return tokens
+    
+    def _compact(self):
+        """Squeeze out masked columns once they are a quarter of the batch's keys/values"""
+        if not self.sequences:
+            return
+        real = self.attention_mask.bool()
+        width = real.shape[1]
+        longest = int(real.sum(dim=1).max())
+        if width - longest <= width // 4:
+            return
+        # A stable sort moves each row's real columns to the right, in order, leaving left padding as usual
+        index = real.int().sort(dim=1, stable=True).indices[:, width - longest:]
+        self.attention_mask = real.gather(1, index).long()
+        self.past = tuple(
+            (key.gather(2, index[:, None, :, None].expand(-1, key.shape[1], -1, key.shape[3])),
+             value.gather(2, index[:, None, :, None].expand(-1, value.shape[1], -1, value.shape[3])))
+            for key, value in self.past
+        )
+    
+    def _record(self, rows, accepted=None):
+        """Append each row's accepted drafts and sampled token, stream its text, drop finished sequences; returns the token count"""
+        finished = set()
+        appended = 0
+        now = time.monotonic()
+        for row in rows:
+            sequence = self.sequences[row]
+            tokens = (accepted or {}).get(row, []) + [int(self.next_tokens[row])]
+            reason = None
+            for token in tokens:
+                appended += 1
+                if token in self.eos_ids:
+                    reason = "stop"
+                else:
+                    delta = sequence.add_token(token, self.tokenizer)
+                    if delta is None:
+                        reason = "stop"
+                    elif delta and sequence.events is not None:
+                        sequence.events.put(("delta", delta))
+                if reason is not None or len(sequence.generated) >= sequence.max_new_tokens:
+                    break
+            if reason is None:
+                if sequence.cancelled:
+                    reason = "cancelled"
+                elif len(sequence.generated) >= sequence.max_new_tokens:
+                    reason = "length"
+                elif sequence.deadline is not None and now >= sequence.deadline:
+                    reason = "deadline"
+            if reason is not None:
+                sequence.finish(reason)
+                finished.add(row)
+                if self.prefix_cache is not None:
+                    self._store_row(row)
+        if finished:
+            self._remove(finished)
+        return appended
+    
+    def _store_row(self, row):
+        """Cache a finished row's prompt and reply, the likely prefix of the conversation's next turn"""
+        real = self.attention_mask[row].bool()
+        sequence = self.sequences[row]
+        # The most recently sampled token hasn't been fed through the model, so it has no keys/values yet
+        token_ids = (sequence.prompt_ids + sequence.generated)[:int(real.sum())]
+        # A reply that stopped partway through accepted drafts has fed more tokens than it kept
+        self.prefix_cache.store(token_ids, tuple((key[row:row + 1][:, :, real][:, :, :len(token_ids)],
+                                                  value[row:row + 1][:, :, real][:, :, :len(token_ids)])
+                                                 for key, value in self.past))
+    
+    def _remove(self, rows):
+        keep = [row for row in range(len(self.sequences)) if row not in rows]
+        self.sequences = [self.sequences[row] for row in keep]
+        if not keep:
+            self.past, self.attention_mask, self.next_tokens = None, None, None
+            return
+        index = torch.tensor(keep)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Columns that are padding in every remaining row can go
+        start = int(attention_mask.any(dim=0).int().argmax())
+        self.attention_mask = attention_mask[:, start:]
+        self.past = tuple((key.index_select(0, index)[:, :, start:], value.index_select(0, index)[:, :, start:])
+                          for key, value in self.past)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+
+class ModelWorker:
+    """Loads the model once and runs queued chats through the batch scheduler on one long-lived thread"""
+    def __init__(self, max_queued=MAX_QUEUED_CHATS, weights_path=None):
+        self.jobs = queue.Queue(maxsize=max_queued)
+        self.weights_path = weights_path
+        self.ready = threading.Event()
+        self.error = None
+        self.ai_client = None
+        self.scheduler = None
+        self.thread = threading.Thread(target=self.run, name="model-worker", daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def status(self):
+        if self.ready.is_set():
+            return "ready"
+        return "failed" if self.error is not None else "loading"
+    
+    def stats(self):
+        return self.scheduler.stats() if self.scheduler is not None else {}
+    
+    def submit(self, user_message, max_new_tokens=None, stop=(), timeout=None, stream=False, events=None):
+        # Raises queue.Full when too many chats are already waiting
+        max_new_tokens = min(max_new_tokens or MODEL_PARAMS["max_new_tokens"], MODEL_PARAMS["max_new_tokens"])
+        timeout = min(timeout or MAX_GENERATION_TIME, MAX_GENERATION_TIME)
+        sequence = Sequence(self.ai_client.tokenizer(user_message)["input_ids"], max_new_tokens, stop,
+                            time.monotonic() + timeout, stream, events)
+        self.jobs.put_nowait(sequence)
+        return sequence
+    
+    def run(self):
+        try:
+            self.ai_client = AIClient(self.weights_path)
+            self.ai_client.warm_up()
+            self.scheduler = BatchScheduler(self.ai_client)
+        except Exception as e:
+            self.error = e
+            return
+        self.ready.set()
+        self.scheduler.run(self.jobs)
+
+def parse_cpu_list(text):
+    # "0-3,8,10-11" (the kernel's cpulist format) -> [0, 1, 2, 3, 8, 10, 11]
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def numa_nodes():
+    # CPUs of each NUMA node, empty where sysfs doesn't describe any
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"),
+                       key=lambda path: int(os.path.basename(os.path.dirname(path))[4:])):
+        try:
+            with open(path) as f:
+                nodes.append(parse_cpu_list(f.read()))
+        except (OSError, ValueError):
+            continue
+    return nodes
+
+def plan_replicas(replicas, threads=THREADS_PER_REPLICA):
+    """Split the CPUs this process may use into one (cpus, threads) set per replica.
+
+    Replicas are dealt round-robin over NUMA nodes and each gets a slice of one
+    node's cores, so its threads and the memory they first touch stay on that node.
+    """
+    allowed = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    groups = [[cpu for cpu in node if cpu in allowed] for node in numa_nodes()]
+    groups = [group for group in groups if group] or [allowed]
+    members = [list(range(replicas))[start::len(groups)] for start in range(len(groups))]
+    plan = [None] * replicas
+    for group, indexes in zip(groups, members):
+        size = max(1, len(group) // len(indexes)) if indexes else 0
+        for position, index in enumerate(indexes):
+            # More replicas than cores on a node: the extra ones share the whole node
+            cpus = group[position * size:(position + 1) * size] or group
+            plan[index] = (cpus, threads or len(cpus))
+    return plan
+
+class ReplicaEvents:
+    """Stands in for a Sequence's event queue inside a replica, forwarding events to the router process"""
+    def __init__(self, job_id, responses):
+        self.job_id = job_id
+        self.responses = responses
+    
+    def put(self, event):
+        self.responses.put(("event", self.job_id, event))
+
+def replica_main(index, cpus, threads, weights_path, requests, responses):
+    """Runs in each replica process: pin to its cores, map the shared weights, then serve chats from requests"""
+    # Threads inherit the affinity, so this has to happen before torch starts its thread pool
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    worker = ModelWorker(weights_path=weights_path)
+    worker.start()
+    while not worker.ready.wait(0.5):
+        if worker.error is not None:
+            responses.put(("failed", index, str(worker.error)))
+            return
+    responses.put(("ready", index, None))
+    sequences = {}
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        kind, job_id, value = message
+        for finished in [job for job, sequence in sequences.items() if sequence.future.done()]:
+            del sequences[finished]
+        if kind == "cancel":
+            if job_id in sequences:
+                sequences[job_id].cancel()
+            continue
+        user_message, options = value
         try:
-            inputs = self.tokenizer(user_message, return_tensors="pt")
-            outputs = self.model.generate(
-                **inputs,
-                **MODEL_PARAMS
-            )
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            return response[len(user_message):].strip()
+            sequences[job_id] = worker.submit(user_message, events=ReplicaEvents(job_id, responses), **options)
+        except queue.Full:
+            responses.put(("event", job_id, ("busy", None)))
         except Exception as e:
-            print(f"AI Error: {str(e)}")
-            return f"Error: {str(e)}"
+            responses.put(("event", job_id, ("error", str(e))))
+        else:
+            responses.put(("event", job_id, ("accepted", None)))
+
+class RemoteSequence:
+    """Router side of a chat running in a replica, used by the handler just like a Sequence"""
+    def __init__(self, job_id, replica, stream):
+        self.job_id = job_id
+        self.replica = replica
+        self.future = Future()
+        self.events = queue.Queue() if stream else None
+        self.parts = []
+        # Set once the replica has queued the chat or turned it away
+        self.admitted = threading.Event()
+        self.busy = False
+    
+    def cancel(self):
+        self.replica.requests.put(("cancel", self.job_id, None))
+    
+    def deliver(self, kind, value):
+        if kind != "delta":
+            self.admitted.set()
+        if kind in ("accepted", "busy"):
+            self.busy = kind == "busy"
+            return
+        if kind == "delta":
+            self.parts.append(value)
+        if self.events is not None:
+            self.events.put((kind, value))
+        if kind == "done":
+            self.future.set_result(("".join(self.parts).strip(), value))
+        elif kind == "error":
+            self.future.set_exception(RuntimeError(value))
+
+class Replica:
+    """One model process as the router sees it"""
+    def __init__(self, index, cpus, threads):
+        self.index = index
+        self.cpus = cpus
+        self.threads = threads
+        self.process = None
+        self.requests = None
+        self.ready = False
+        self.error = None
+        self.in_flight = 0
+        self.restarts = 0
+    
+    def describe(self):
+        status = "ready" if self.ready else ("failed" if self.error is not None else "loading")
+        return {"status": status, "cpus": self.cpus, "threads": self.threads,
+                "in_flight": self.in_flight, "restarts": self.restarts}
+
+class ReplicaRouter:
+    """Runs the model in several pinned processes and sends each chat to the replica with the fewest in flight.
+
+    Offers the same interface as ModelWorker to the request handler. Weights are
+    exported once to a safetensors file that every replica maps read-only.
+    """
+    def __init__(self, replicas=REPLICAS, threads=THREADS_PER_REPLICA, max_queued=MAX_QUEUED_CHATS):
+        # spawn rather than fork: torch's thread pools don't survive a fork
+        self.context = multiprocessing.get_context("spawn")
+        self.replicas = [Replica(index, cpus, replica_threads)
+                         for index, (cpus, replica_threads) in enumerate(plan_replicas(replicas, threads))]
+        # Queued chats plus a full batch on every replica
+        self.capacity = max_queued + len(self.replicas) * MAX_BATCH_SIZE
+        self.responses = self.context.Queue()
+        self.sequences = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.weights_path = None
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="replica-router", daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def status(self):
+        if self.ready.is_set():
+            return "ready"
+        return "failed" if self.error is not None else "loading"
+    
+    def stats(self):
+        return {"replicas": [replica.describe() for replica in self.replicas]}
+    
+    def submit(self, user_message, max_new_tokens=None, stop=(), timeout=None, stream=False):
+        # Raises queue.Full when every replica is busy and too many chats are already waiting
+        with self.lock:
+            candidates = [replica for replica in self.replicas if replica.ready]
+            if not candidates or sum(replica.in_flight for replica in self.replicas) >= self.capacity:
+                raise queue.Full
+            replica = min(candidates, key=lambda replica: replica.in_flight)
+            replica.in_flight += 1
+            sequence = RemoteSequence(next(self.job_ids), replica, stream)
+            self.sequences[sequence.job_id] = sequence
+        options = {"max_new_tokens": max_new_tokens, "stop": list(stop), "timeout": timeout}
+        replica.requests.put(("chat", sequence.job_id, (user_message, options)))
+        # Wait for the replica's own queue to take it, so a full one still ends in a 503 before any response starts
+        if not sequence.admitted.wait(REPLICA_ACCEPT_TIMEOUT):
+            sequence.cancel()
+            raise queue.Full
+        if sequence.busy:
+            raise queue.Full
+        return sequence
+    
+    def run(self):
+        try:
+            if can_map_weights(MODEL_NAME):
+                self.weights_path = export_weights(MODEL_NAME, WEIGHT_FORMAT)
+            else:
+                print(f"{MODEL_NAME} has its own quantized layers, each replica loads a private copy")
+        except Exception as e:
+            print(f"Failed to export weights: {str(e)}")
+            self.error = e
+            return
+        for replica in self.replicas:
+            self._spawn(replica)
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check >= 1:
+                self._check_replicas()
+                last_check = time.monotonic()
+            try:
+                kind, key, value = self.responses.get(timeout=1)
+            except queue.Empty:
+                continue
+            if kind == "event":
+                self._deliver(key, *value)
+            elif kind == "ready":
+                print(f"Replica {key} ready on CPUs {self.replicas[key].cpus}")
+                self.replicas[key].ready = True
+                self.ready.set()
+            elif kind == "failed":
+                print(f"Replica {key} failed to load: {value}")
+                self.replicas[key].error = RuntimeError(value)
+                if all(replica.error is not None for replica in self.replicas):
+                    self.error = self.replicas[key].error
+    
+    def _spawn(self, replica):
+        replica.requests = self.context.Queue()
+        replica.process = self.context.Process(
+            target=replica_main, name=f"bitnet-replica-{replica.index}", daemon=True,
+            args=(replica.index, replica.cpus, replica.threads, self.weights_path, replica.requests, self.responses))
+        replica.process.start()
+    
+    def _deliver(self, job_id, kind, value):
+        with self.lock:
+            sequence = self.sequences.get(job_id)
+            if sequence is None:
+                return
+            if kind in ("done", "error", "busy"):
+                del self.sequences[job_id]
+                sequence.replica.in_flight -= 1
+        sequence.deliver(kind, value)
+    
+    def _check_replicas(self):
+        for replica in self.replicas:
+            if replica.process is None or replica.process.is_alive():
+                continue
+            print(f"Replica {replica.index} exited with code {replica.process.exitcode}")
+            with self.lock:
+                replica.ready = False
+                lost = [sequence for sequence in self.sequences.values() if sequence.replica is replica]
+                for sequence in lost:
+                    del self.sequences[sequence.job_id]
+                replica.in_flight = 0
+            if not any(other.ready for other in self.replicas):
+                self.ready.clear()
+            for sequence in lost:
+                sequence.deliver("error", "Model replica exited")
+            if replica.error is not None:
+                # Failed to load, restarting would only fail again
+                replica.process = None
+                continue
+            replica.restarts += 1
+            self._spawn(replica)
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, ai_client=None, **kwargs):
-        self.ai_client = ai_client or AIClient()
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body are separate writes, so don't let Nagle hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+    
+    def __init__(self, *args, worker=None, **kwargs):
+        self.worker = worker
+        self.requests_served = 0
         super().__init__(*args, **kwargs)
     
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.requests_served += 1
+        if self.requests_served >= KEEP_ALIVE_MAX_REQUESTS:
+            self.send_header('Connection', 'close')
+    
     def do_GET(self):
         try:
             if self.path in ('/', '/index.html'):
                 self.serve_file('index.html', 'text/html')
+            elif self.path == '/api/ready':
+                status = self.worker.status()
+                data = {"status": status}
+                if self.worker.error is not None:
+                    data["error"] = str(self.worker.error)
+                data.update(self.worker.stats())
+                self.send_json(200 if status == "ready" else 503, data)
             else:
                 self.serve_file(self.path[1:])
         except Exception as e:
@@ -68,13 +990,15 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             content_type = self.headers.get('Content-Type', '')
+            # Read the body even for unknown paths so the next request on the connection starts clean
+            post_data = self.rfile.read(content_length)
             
-            if self.path == '/api/chat':
-                post_data = self.rfile.read(content_length)
-                
+            if self.path in ('/api/chat', '/api/chat/stream'):
+                options = {}
                 if 'application/json' in content_type:
                     data = json.loads(post_data.decode('utf-8'))
                     user_message = data.get('message', '').strip()
+                    options = self.parse_options(data)
                 else:
                     data = parse_qs(post_data.decode('utf-8'))
                     user_message = unquote(data.get('message', [''])[0]).strip()
@@ -82,15 +1006,86 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                 if not user_message:
                     self.send_json(400, {"error": "Message is required"})
                     return
+                if options is None:
+                    self.send_json(400, {"error": f"max_new_tokens and timeout must be positive numbers, stop at most {MAX_STOP_SEQUENCES} strings"})
+                    return
                 
-                response = self.ai_client.get_response(user_message)
-                self.send_json(200, {"response": response})
+                if not self.worker.ready.is_set():
+                    self.send_json(503, {"error": f"Model is {self.worker.status()}"}, {"Retry-After": "10"})
+                    return
+                stream = self.path == '/api/chat/stream' or 'text/event-stream' in self.headers.get('Accept', '')
+                try:
+                    sequence = self.worker.submit(user_message, stream=stream, **options)
+                except queue.Full:
+                    self.send_json(503, {"error": "Too many chats waiting, try again later"}, {"Retry-After": "5"})
+                    return
+                if stream:
+                    self.stream_events(sequence)
+                    return
+                response, finish_reason = sequence.future.result()
+                self.send_json(200, {"response": response, "finish_reason": finish_reason})
             else:
                 self.send_json(404, {"error": "Endpoint not found"})
         except Exception as e:
             self.send_json(500, {"error": f"Server error: {str(e)}"})
             print(f"POST error: {e}")
     
+    def parse_options(self, data):
+        # Optional per-chat limits from a JSON body, None if any of them is malformed
+        options = {}
+        for name, kind in (('max_new_tokens', int), ('timeout', (int, float))):
+            value = data.get(name)
+            if value is not None:
+                if isinstance(value, bool) or not isinstance(value, kind) or value <= 0:
+                    return None
+                options[name] = value
+        stop = data.get('stop')
+        if stop is not None:
+            stop = [stop] if isinstance(stop, str) else stop
+            if not isinstance(stop, list) or len(stop) > MAX_STOP_SEQUENCES or not all(isinstance(text, str) for text in stop):
+                return None
+            options['stop'] = stop
+        return options
+    
+    def stream_events(self, sequence):
+        # Server-Sent Events, one event per decoded piece of text. HTTP/1.0 clients don't understand
+        # chunked bodies, so they get the raw stream and the end of the connection marks its end
+        self.chunked = self.request_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        try:
+            while True:
+                kind, value = sequence.events.get()
+                if kind == "delta":
+                    self.send_event({"delta": value})
+                    continue
+                if kind == "done":
+                    self.send_event({"finish_reason": value}, "done")
+                else:
+                    self.send_event({"error": value}, "error")
+                break
+            if self.chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Nobody is reading any more, free the batch slot
+            sequence.cancel()
+            self.close_connection = True
+    
+    def send_event(self, data, event=None):
+        payload = (f"event: {event}\n" if event else "") + f"data: {json.dumps(data)}\n\n"
+        payload = payload.encode('utf-8')
+        if self.chunked:
+            payload = f"{len(payload):x}\r\n".encode() + payload + b"\r\n"
+        self.wfile.write(payload)
+    
     def serve_file(self, filename, content_type=None):
         if '..' in filename or filename.startswith('/'):
             self.send_error(403, "Forbidden")
@@ -110,15 +1105,20 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         
         self.send_response(200)
         self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(content)))
         self.end_headers()
         self.wfile.write(content)
     
-    def send_json(self, status_code, data):
+    def send_json(self, status_code, data, headers=None):
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        body = json.dumps(data).encode('utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(body)
     
     def guess_content_type(self, filename):
         ext = os.path.splitext(filename)[1].lower()
@@ -135,9 +1135,12 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             '.txt': 'text/plain'
         }.get(ext, 'application/octet-stream')
 
-def run_server(port=PORT):    
+def run_server(port=PORT):
+    # The model loads in the background; /api/ready reports when chats can be served
+    worker = ReplicaRouter(REPLICAS) if REPLICAS > 1 else ModelWorker()
+    worker.start()
     server_address = ('', port)
-    httpd = HTTPServer(server_address, lambda *args: HTTPRequestHandler(*args))
+    httpd = ThreadingHTTPServer(server_address, lambda *args: HTTPRequestHandler(*args, worker=worker))
     print(f'Server running on port {port}')
     try:
         httpd.serve_forever()
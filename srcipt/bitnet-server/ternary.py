@@ -0,0 +1,120 @@
+"""Packed ternary linear layers for running BitNet b1.58 models on CPU.
+
+BitNet b1.58 linear weights only take the values -1, 0 and +1 times one
+absmean scale per matrix, so each weight fits in 2 bits. pack_model swaps a
+model's nn.Linear layers for TernaryLinear, which keeps four weights per byte
+and unpacks them block by block inside the matmul.
+
+This saves memory, not time. The matmul itself still runs on floats, and
+unpacking every weight again on each forward pass makes decoding slower than
+keeping the float32 weights resident.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# 2-bit codes: 0 -> -1, 1 -> 0, 2 -> +1, four per byte from the low bits up
+SHIFTS = torch.tensor([0, 2, 4, 6], dtype=torch.uint8)
+# Weights unpacked at once in a forward pass, bounding the float scratch buffer (16 MiB as float32)
+UNPACK_BLOCK = 1 << 22
+
+def quantize(weight):
+    # Absmean quantization from BitNet b1.58: weight ~= scale * values with values in {-1, 0, 1}
+    weight = weight.float()
+    magnitudes = weight.abs()
+    nonzero = magnitudes[magnitudes > 0]
+    if nonzero.numel() and nonzero.max() - nonzero.min() <= 1e-6 * nonzero.max():
+        # Already ternary (exported after quantization), keep its own scale so packing is lossless
+        scale = nonzero.max()
+    else:
+        scale = magnitudes.mean().clamp(min=1e-5)
+    return (weight / scale).round().clamp(-1, 1).to(torch.int8), scale
+
+def pack(values):
+    # [out, in] int8 ternary values -> [out, ceil(in / 4)] uint8
+    out_features, in_features = values.shape
+    # Padding uses code 1, which unpacks to 0 and so adds nothing to the dot product
+    codes = torch.ones((out_features, (in_features + 3) // 4 * 4), dtype=torch.uint8)
+    codes[:, :in_features] = (values + 1).to(torch.uint8)
+    codes = codes.view(out_features, -1, 4)
+    return codes[..., 0] | (codes[..., 1] << 2) | (codes[..., 2] << 4) | (codes[..., 3] << 6)
+
+def unpack(packed, in_features, dtype=torch.float32):
+    # Shift and mask every byte four ways at once, then map codes 0/1/2 back to -1/0/+1
+    codes = (packed.unsqueeze(-1) >> SHIFTS) & 3
+    return codes.view(packed.shape[0], -1)[:, :in_features].to(dtype) - 1
+
+class TernaryLinear(nn.Module):
+    """Linear layer with 2-bit packed ternary weights and one float scale"""
+    def __init__(self, in_features, out_features, packed, scale, bias=None, activation_quant=False, input_norm=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("packed", packed)
+        self.register_buffer("scale", scale.reshape(()).float())
+        self.bias = nn.Parameter(bias, requires_grad=False) if bias is not None else None
+        self.activation_quant = activation_quant
+        self.input_norm = input_norm
+        self.block_rows = max(1, UNPACK_BLOCK // in_features)
+
+    @classmethod
+    def from_linear(cls, linear):
+        values, scale = quantize(linear.weight.data)
+        bias = linear.bias.data.clone() if linear.bias is not None else None
+        # BitNet's own online-quantized linear layers also quantize activations and may normalise their input first
+        return cls(linear.in_features, linear.out_features, pack(values), scale, bias,
+                   activation_quant=bool(getattr(linear, 'online_quant', False)),
+                   input_norm=getattr(linear, 'rms_norm', None))
+
+    @classmethod
+    def empty_like(cls, linear):
+        # Same layout as from_linear but uninitialised, for loading a saved packed state dict into
+        packed = torch.empty((linear.out_features, (linear.in_features + 3) // 4), dtype=torch.uint8)
+        bias = torch.empty_like(linear.bias.data) if linear.bias is not None else None
+        return cls(linear.in_features, linear.out_features, packed, torch.ones(()), bias,
+                   activation_quant=bool(getattr(linear, 'online_quant', False)),
+                   input_norm=getattr(linear, 'rms_norm', None))
+
+    def forward(self, x):
+        if self.input_norm is not None:
+            x = self.input_norm(x)
+        if self.activation_quant:
+            # Per-token 8-bit absmax, as BitNet does during training and inference
+            scale = 127.0 / x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-5)
+            x = (x * scale).round().clamp(-128, 127) / scale
+        if self.out_features <= self.block_rows:
+            y = F.linear(x, unpack(self.packed, self.in_features, x.dtype))
+        else:
+            y = torch.cat([F.linear(x, unpack(self.packed[start:start + self.block_rows], self.in_features, x.dtype))
+                           for start in range(0, self.out_features, self.block_rows)], dim=-1)
+        y = y * self.scale.to(x.dtype)
+        if self.bias is not None:
+            y = y + self.bias
+        return y
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+def pack_model(model, dtype=torch.float32, skip=("lm_head",), empty=False):
+    # Replace linear layers in place, then cast the rest (embeddings, norms, head) to dtype; returns the count packed.
+    # empty=True skips quantizing and only lays out the packed buffers, for load_state_dict to fill
+    make = TernaryLinear.empty_like if empty else TernaryLinear.from_linear
+    packed = 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear) and name not in skip:
+                setattr(module, name, make(child))
+                packed += 1
+    # Module.to(dtype) only casts floating point tensors, so the packed bytes stay uint8
+    model.to(dtype)
+    return packed
+
+def weight_bytes(model):
+    # Bytes held by parameters and buffers, counting shared (tied) tensors once
+    seen = set()
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.data_ptr() not in seen:
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
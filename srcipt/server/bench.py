@@ -0,0 +1,343 @@
+"""Load-testing harness for server.py against a local mock upstream.
+
+Starts a mock OpenAI-style streaming completion endpoint, runs server.py in a
+child process pointed at it, drives the server with concurrent clients and
+reports throughput, latency percentiles and server memory. Results are saved
+as JSON so runs can be compared:
+
+    python bench.py --concurrency 32 --duration 20 --output results.json
+    python bench.py --concurrency 32 --duration 20 --baseline results.json
+"""
+import os
+import sys
+import math
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Optional, Dict, List, Iterator
+
+MOCK_WORDS = "the quick brown fox jumps over the lazy dog while the server relays every token".split()
+
+class MockSettings:
+    """Shape of the simulated upstream"""
+    def __init__(self, ttft: float = 0.3, token_rate: float = 50.0, tokens: int = 200, error_rate: float = 0.0):
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+
+    def tokens_for(self, seed: str) -> Iterator[str]:
+        """Yield the reply one token at a time, paced like a real model"""
+        rng = random.Random(seed)
+        time.sleep(self.ttft)
+        delay = 1 / self.token_rate if self.token_rate > 0 else 0
+        for _ in range(self.tokens):
+            yield rng.choice(MOCK_WORDS) + " "
+            if delay:
+                time.sleep(delay)
+
+    def pick_error(self) -> Optional[int]:
+        """Status code to fail this call with, if error injection fires"""
+        if self.error_rate and random.random() < self.error_rate:
+            return random.choice((429, 500))
+        return None
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible /chat/completions endpoint that streams fake tokens"""
+    protocol_version = "HTTP/1.1"
+    settings = MockSettings()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_error(404, "Not found")
+            return
+        error = self.settings.pick_error()
+        if error is not None:
+            self._send_error(error, "Injected failure")
+            return
+
+        request = json.loads(body or b'{}')
+        model = request.get('model', 'mock')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for token in self.settings.tokens_for(json.dumps(request.get('messages'))):
+                self._write_event(json.dumps({
+                    "id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "system_fingerprint": "mock",
+                    "choices": [{"index": 0, "delta": {"role": "assistant", "content": token},
+                                 "finish_reason": None, "logprobs": None}]
+                }))
+            self._write_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _write_event(self, data: str):
+        payload = f"data: {data}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(payload):x}\r\n".encode('ascii') + payload + b"\r\n")
+
+    def _send_error(self, code: int, message: str):
+        body = json.dumps({"error": message}).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if code == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_mock_upstream(settings: MockSettings, port: int = 0) -> ThreadingHTTPServer:
+    """Start the mock upstream on a background thread"""
+    handler = type("ConfiguredMockHandler", (MockUpstreamHandler,), {"settings": settings})
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=httpd.serve_forever, name="mock-upstream", daemon=True).start()
+    return httpd
+
+class MockInferenceClient:
+    """Drop-in for InferenceClient whose chat.completions.create streams fake tokens in-process"""
+    settings = MockSettings()
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model: str, messages: List[Dict], **params):
+        error = self.settings.pick_error()
+        if error is not None:
+            failure = RuntimeError(f"Injected failure ({error})")
+            failure.response = SimpleNamespace(status_code=error, headers={'Retry-After': '1'})
+            raise failure
+        return (
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+            for token in self.settings.tokens_for(json.dumps(messages))
+        )
+
+def serve(options: Dict):
+    """Child-process entry point: run server.py configured for benchmarking"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if options["upstream"] == "inprocess":
+        # Lets the benchmark run without huggingface_hub installed
+        import types
+        sys.modules.setdefault("huggingface_hub", types.SimpleNamespace(InferenceClient=MockInferenceClient))
+    import server
+
+    settings = MockSettings(**options["mock"])
+    MockInferenceClient.settings = settings
+    if options["upstream"] == "inprocess":
+        server.InferenceClient = MockInferenceClient
+
+    server.CONFIG["UPSTREAMS"] = [{"name": "mock", "base_url": options["base_url"], "api_key": "mock"}]
+    server.CONFIG["PREWARM"] = False
+    server.CONFIG["CACHE"]["ENABLED"] = options["cache"]
+    server.CONFIG["CACHE"]["DISK_PATH"] = None
+    server.CONFIG["COALESCE_REQUESTS"] = options["coalesce"]
+    server.CONFIG["SESSIONS"]["ENABLED"] = False
+    server.CONFIG["RATE_LIMIT"]["REQUESTS_PER_MINUTE"] = 10 ** 9
+    server.CONFIG["RATE_LIMIT"]["ROUTES"] = {}
+    server.admission.max_concurrent = options["upstream_calls"]
+    server.admission.max_queued = options["queued_calls"]
+
+    httpd = server.create_server(('127.0.0.1', options["port"]), server.HTTPRequestHandler, options["mode"])
+    httpd.serve_forever()
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def read_rss(pid: int) -> Optional[int]:
+    """Resident set size of a process in bytes (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+class LoadGenerator:
+    """Concurrent clients hitting the server over persistent connections"""
+    def __init__(self, port: int, path: str, concurrency: int, duration: float, unique_ratio: float):
+        self.port = port
+        self.path = path
+        self.concurrency = concurrency
+        self.duration = duration
+        self.unique_ratio = unique_ratio
+        self.latencies: List[float] = []
+        self.first_bytes: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def _prompt(self, rng: random.Random) -> str:
+        if rng.random() < self.unique_ratio:
+            return f"unique prompt {rng.getrandbits(64):x}"
+        return f"shared prompt {rng.randrange(10)}"
+
+    def _client(self, seed: int, stop_at: float):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        while time.perf_counter() < stop_at:
+            body = json.dumps({"message": self._prompt(rng)})
+            started = time.perf_counter()
+            try:
+                connection.request('POST', self.path, body=body, headers={'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read(1)
+                first_byte = time.perf_counter() - started
+                response.read()
+                status = str(response.status)
+                if response.will_close:
+                    connection.close()
+            except (OSError, http.client.HTTPException) as e:
+                status = type(e).__name__
+                first_byte = None
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                if status == '200':
+                    self.latencies.append(elapsed)
+                    if first_byte is not None:
+                        self.first_bytes.append(first_byte)
+        connection.close()
+
+    def run(self, server_pid: Optional[int] = None) -> Dict:
+        """Drive the server for the configured duration and summarise what happened"""
+        stop_at = time.perf_counter() + self.duration
+        clients = [threading.Thread(target=self._client, args=(seed, stop_at), daemon=True) for seed in range(self.concurrency)]
+        started = time.perf_counter()
+        for client in clients:
+            client.start()
+
+        peak_rss = None
+        while any(client.is_alive() for client in clients):
+            rss = read_rss(server_pid) if server_pid else None
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(self.latencies)
+        first_bytes = sorted(self.first_bytes)
+        total = sum(self.statuses.values())
+        return {
+            "requests": total,
+            "ok": len(latencies),
+            "statuses": self.statuses,
+            "elapsed_sec": elapsed,
+            "rps": len(latencies) / elapsed if elapsed else 0,
+            "latency_sec": {name: percentile(latencies, q) for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+            "first_byte_sec": {name: percentile(first_bytes, q) for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+            "server_peak_rss_bytes": peak_rss,
+        }
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+def compare(results: Dict, baseline: Dict):
+    """Print how this run moved against a saved one"""
+    def change(new, old):
+        if not new or not old:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+    print("\nAgainst baseline:")
+    print(f"  rps            {change(results['rps'], baseline['rps'])}")
+    for name in ("p50", "p95", "p99"):
+        print(f"  latency {name}    {change(results['latency_sec'][name], baseline['latency_sec'][name])}")
+    print(f"  peak RSS       {change(results['server_peak_rss_bytes'], baseline['server_peak_rss_bytes'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--path", default="/api/chat", help="endpoint to hit, e.g. /api/chat/stream")
+    parser.add_argument("--unique-ratio", type=float, default=1.0, help="share of prompts that are never repeated")
+    parser.add_argument("--mode", default="pool", choices=("single", "thread", "pool"), help="server.py serving mode")
+    parser.add_argument("--upstream", default="http", choices=("http", "inprocess"),
+                        help="mock behind a real InferenceClient over HTTP, or swapped in for it")
+    parser.add_argument("--upstream-calls", type=int, default=64, help="server MAX_UPSTREAM_CALLS")
+    parser.add_argument("--queued-calls", type=int, default=256, help="server MAX_QUEUED_CALLS")
+    parser.add_argument("--cache", action="store_true", help="enable the response cache")
+    parser.add_argument("--no-coalesce", dest="coalesce", action="store_false")
+    parser.add_argument("--ttft", type=float, default=0.3, help="mock time to first token (sec)")
+    parser.add_argument("--token-rate", type=float, default=50, help="mock tokens per second")
+    parser.add_argument("--tokens", type=int, default=200, help="mock tokens per reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of mock calls failing with 429/500")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="compare against a previous results JSON")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(json.loads(args.serve))
+        return
+
+    mock = {"ttft": args.ttft, "token_rate": args.token_rate, "tokens": args.tokens, "error_rate": args.error_rate}
+    mock_httpd = None
+    base_url = "http://mock.invalid"
+    if args.upstream == "http":
+        mock_httpd = run_mock_upstream(MockSettings(**mock))
+        base_url = f"http://127.0.0.1:{mock_httpd.server_address[1]}"
+
+    port = free_port()
+    options = {
+        "port": port, "mode": args.mode, "upstream": args.upstream, "base_url": base_url, "mock": mock,
+        "cache": args.cache, "coalesce": args.coalesce,
+        "upstream_calls": args.upstream_calls, "queued_calls": args.queued_calls,
+    }
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", json.dumps(options)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        idle_rss = read_rss(child.pid)
+        generator = LoadGenerator(port, args.path, args.concurrency, args.duration, args.unique_ratio)
+        results = generator.run(child.pid)
+    finally:
+        child.terminate()
+        child.wait()
+        if mock_httpd is not None:
+            mock_httpd.shutdown()
+
+    results["server_idle_rss_bytes"] = idle_rss
+    results["settings"] = {key: value for key, value in vars(args).items() if key not in ("serve", "output", "baseline")}
+    results["timestamp"] = time.time()
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,35 @@
 import os
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import unquote, parse_qs
+import threading
+import hashlib
+import gzip
+import sqlite3
+import sys
+import math
+import queue
+import random
+import uuid
+import select
+import base64
+import struct
+import signal
+import socket
+import tempfile
+import shutil
+import contextlib
+import atexit
+import logging.handlers
+from multiprocessing.managers import BaseManager
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import unquote, parse_qs, urlsplit
+from email.utils import formatdate, parsedate_to_datetime
 from huggingface_hub import InferenceClient
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Iterator, Callable
 import json
-from collections import defaultdict
 import logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
-)
-
 # Configuration Constants
 CONFIG = {
     "PORT": 1234,
@@ -34,6 +47,21 @@ CONFIG = {
 
     """,
     "MODEL_NAME": "deepseek-ai/DeepSeek-V3-0324",
+    # Each upstream needs a "provider" or an OpenAI-compatible "base_url" (e.g. a local stand-in),
+    # plus an "api_key" or "api_key_file" (defaults to API_KEY_FILE); "model" overrides MODEL_NAME
+    "UPSTREAMS": [
+        {"name": "nebius", "provider": "nebius"}
+    ],
+    "UPSTREAM_HEALTH": {
+        "MAX_FAILURES": 3,  # Consecutive errors before an upstream is taken out of rotation
+        "COOLDOWN": 30  # Seconds an unhealthy or rate-limited upstream sits out
+    },
+    "HEDGE": {
+        "ENABLED": False,  # Fire a second upstream when the first is slower than usual to start
+        "QUANTILE": 0.95,  # Hedge after this quantile of the upstream's time-to-first-token
+        "MIN_DELAY": 1.0,  # Never hedge sooner than this (sec)
+        "MAX_HEDGES": 1
+    },
     "MODEL_PARAMS": {
         "temperature": 0.1,
         "max_tokens": 4096,
@@ -42,214 +70,2110 @@ CONFIG = {
     },
     "RATE_LIMIT": {
         "REQUESTS_PER_MINUTE": 30,  # Max requests per IP per minute
-        "BAN_TIME": 30  # 30 sec ban for exceeding rate limit
+        "BAN_TIME": 30,  # 30 sec ban for exceeding rate limit
+        "ROUTES": {  # Per-route overrides of REQUESTS_PER_MINUTE, each with its own bucket
+            "/api/chat": 30,
+            "/api/chat/stream": 30,
+            "/api/chat/batch": 5
+        },
+        "IDLE_TIMEOUT": 120,  # Forget IPs that have been quiet this long (sec)
+        "SWEEP_INTERVAL": 60  # How often idle IPs and expired bans are evicted (sec)
     },
     "ALLOWED_ORIGINS": ["http://localhost", "http://127.0.0.1"],
-    "MAX_REQUEST_SIZE": 1024 * 10  # 10KB max request size
+    "MAX_REQUEST_SIZE": 1024 * 10,  # 10KB max request size
+    "SERVER_MODE": "pool",  # "single", "thread" (one thread per connection) or "pool"
+    # Pre-forked server processes sharing the port via SO_REUSEPORT (POSIX only); they share the rate limiter,
+    # response cache and MAX_UPSTREAM_CALLS/MAX_QUEUED_CALLS, but coalesce only chats they receive themselves
+    "WORKERS": 1,
+    "WORKER_THREADS": 32,  # Connection handlers in "pool" mode, plus one per allowed WebSocket
+    "MAX_PENDING_CONNECTIONS": 64,  # Connections waiting for a free handler in "pool" mode; more get a 503
+    "MAX_UPSTREAM_CALLS": 8,  # Concurrent calls to the AI provider
+    "MAX_QUEUED_CALLS": 32,  # Chats allowed to wait for an upstream slot; more get a 503
+    "MAX_QUEUE_WAIT": 15,  # Longest a chat may wait for a slot (sec), clients can ask for less with X-Request-Timeout
+    "UPSTREAM_POOL_SIZE": 16,  # Persistent connections kept open to the AI provider
+    "PREWARM": True,  # Open the upstream connection at startup
+    "PREWARM_URL": "https://router.huggingface.co",
+    "CACHE": {
+        "ENABLED": True,
+        "TTL": 60 * 60,  # Seconds a cached response stays valid
+        "MAX_BYTES": 16 * 1024 * 1024,  # Memory budget for cached responses
+        "DISK_PATH": None,  # SQLite file that keeps the cache across restarts, e.g. 'cache.sqlite3'
+        "DISK_MAX_ROWS": 10000,  # Responses kept on disk, the ones closest to expiring go first
+        "DISK_PRUNE_INTERVAL": 5 * 60  # How often puts clear expired responses off the disk (sec)
+    },
+    "COALESCE_REQUESTS": True,  # Identical in-flight chats (to the same worker process) share one upstream call
+    "DISCONNECT_CHECK_INTERVAL": 0.25,  # How often buffered responses check the client is still connected (sec)
+    "BATCH": {
+        "MAX_ITEMS": 500,
+        "CONCURRENCY": 4,  # Items of one batch running upstream at once
+        "MAX_REQUEST_SIZE": 1024 * 1024  # Batches may be larger than single chats
+    },
+    "SESSIONS": {
+        "ENABLED": True,
+        # Runtime state, so it lives in the user's state directory rather than next to the code
+        "DB_PATH": os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state'),
+                                'piton', 'sessions.sqlite3'),
+        "HISTORY_TOKEN_BUDGET": 3000,  # Most recent history sent upstream with each chat
+        "TTL": 24 * 60 * 60  # Sessions idle this long are deleted (sec)
+    },
+    "STATIC": {
+        "MAX_CACHED_FILE_SIZE": 256 * 1024,  # Bigger files are sent straight from disk with sendfile
+        "GZIP_MIN_SIZE": 512,  # Smaller files aren't worth compressing
+        "GZIP_TYPES": ('text/html', 'text/css', 'text/plain', 'application/javascript', 'application/json', 'image/svg+xml')
+    },
+    "KEEP_ALIVE": {
+        "IDLE_TIMEOUT": 5,  # Close persistent connections idle this long (sec)
+        "MAX_REQUESTS": 100  # Requests served on one connection before it is closed
+    },
+    "WEBSOCKET": {
+        "ENABLED": True,
+        "MAX_CONNECTIONS": 16,  # Each open socket holds a worker thread on top of WORKER_THREADS
+        "IDLE_TIMEOUT": 300,  # Close sockets with no client frames for this long (sec)
+        "MAX_MESSAGE_SIZE": 1024 * 1024
+    },
+    "LOGGING": {
+        "ASYNC": True,  # Request threads only enqueue records, a background thread formats and writes them
+        "QUEUE_SIZE": 10000,  # Records beyond this are dropped rather than blocking a response
+        "ACCESS_LOG": True,  # One JSON line per request on the "access" logger
+        # Fraction of access log lines kept for high-volume outcomes, everything else is always logged
+        "SAMPLE_RATES": {"404": 0.1, "429": 0.1, "304": 0.1, "static": 0.1}
+    }
 }
 
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never blocks or formats on the caller's thread"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue stays in-process, so the record can be formatted later by the listener
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped_total")
+
+class JsonFormatter(logging.Formatter):
+    """Render dict log messages as one JSON object per line"""
+    def format(self, record: logging.LogRecord) -> str:
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, separators=(',', ':'))
+        return json.dumps({"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()})
+
+class LogPipeline:
+    """Route the app and access logs through a bounded queue drained by one background thread"""
+    def __init__(self, async_logging: bool = True, queue_size: int = 10000):
+        self.async_logging = async_logging
+        self.queue_size = queue_size
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.handlers = [self._stream_handler(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')),
+                         self._stream_handler(JsonFormatter())]
+        self.access = logging.getLogger("access")
+        self.access.propagate = False
+        self.access.setLevel(logging.INFO)
+        logging.getLogger().setLevel(logging.INFO)
+        self.start()
+    
+    @staticmethod
+    def _stream_handler(formatter: logging.Formatter) -> logging.Handler:
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        return handler
+    
+    def start(self):
+        """Attach the handlers, behind a fresh queue and listener in async mode"""
+        app_handler, access_handler = self.handlers
+        if self.async_logging:
+            log_queue = queue.Queue(maxsize=self.queue_size)
+            # Route each record to the handler of the logger it came from
+            access_handler.addFilter(lambda record: record.name == "access")
+            app_handler.addFilter(lambda record: record.name != "access")
+            self.listener = logging.handlers.QueueListener(log_queue, app_handler, access_handler, respect_handler_level=True)
+            self.listener.start()
+            app_handler = access_handler = DroppingQueueHandler(log_queue)
+        logging.getLogger().handlers = [app_handler]
+        self.access.handlers = [access_handler]
+    
+    def restart_in_child(self):
+        """Replace the listener thread, which doesn't survive a fork"""
+        if self.async_logging:
+            self.listener = None
+            for handler in self.handlers:
+                handler.filters.clear()
+            self.start()
+    
+    def stop(self):
+        """Flush queued records and stop the listener"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+log_pipeline = LogPipeline(CONFIG["LOGGING"]["ASYNC"], CONFIG["LOGGING"]["QUEUE_SIZE"])
+atexit.register(log_pipeline.stop)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=log_pipeline.restart_in_child)
+
+class Metrics:
+    """Thread-safe Prometheus-style counters, gauges and histograms"""
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self.buckets: Dict[str, Tuple[float, ...]] = {}
+        self.values: Dict[str, Dict[Tuple, float]] = defaultdict(lambda: defaultdict(float))
+        # name -> labels -> [per-bucket counts, sum, count]
+        self.histograms: Dict[str, Dict[Tuple, List]] = defaultdict(dict)
+    
+    def describe(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """Register a metric so it is listed even before it is first recorded"""
+        self.kinds[name] = (kind, help_text)
+        if kind == "histogram":
+            self.buckets[name] = buckets
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Add to a counter or gauge"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] += value
+    
+    def observe(self, name: str, value: float, **labels):
+        """Record a sample in a histogram"""
+        key = tuple(sorted(labels.items()))
+        buckets = self.buckets[name]
+        with self.lock:
+            series = self.histograms[name].get(key)
+            if series is None:
+                series = self.histograms[name][key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+    
+    @staticmethod
+    def _labels(pairs: Tuple, extra: str = "") -> str:
+        parts = [f'{name}="{value}"' for name, value in pairs]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+    
+    def render(self) -> str:
+        """Format every metric in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in self.kinds.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind != "histogram":
+                    for labels, value in self.values[name].items():
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+                    continue
+                for labels, (counts, total, count) in self.histograms[name].items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets[name], counts):
+                        cumulative += bucket_count
+                        le = self._labels(labels, f'le="{bound:g}"')
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    le = self._labels(labels, 'le="+Inf"')
+                    lines.append(f"{name}_bucket{le} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("http_requests_total", "counter", "HTTP requests by route, method and status")
+metrics.describe("http_request_duration_seconds", "histogram", "End-to-end request latency by route")
+metrics.describe("http_errors_total", "counter", "Requests that failed with a server-side error")
+metrics.describe("rate_limit_rejections_total", "counter", "Requests rejected by the rate limiter")
+metrics.describe("response_cache_requests_total", "counter", "Response cache lookups by result")
+metrics.describe("coalesced_requests_total", "counter", "Chat requests that joined an identical in-flight upstream call")
+metrics.describe("upstream_in_flight", "gauge", "Upstream calls currently streaming")
+metrics.describe("upstream_queue_depth", "gauge", "Chats waiting for an upstream slot")
+metrics.describe("upstream_queue_wait_seconds", "histogram", "Time chats spent waiting for an upstream slot")
+metrics.describe("admission_rejections_total", "counter", "Chats shed with 503 by reason")
+metrics.describe("upstream_errors_total", "counter", "Upstream calls that raised an error")
+metrics.describe("upstream_attempts_total", "counter", "Calls to each upstream by outcome")
+metrics.describe("hedged_requests_total", "counter", "Extra upstream calls fired because the first was slow")
+metrics.describe("upstream_time_to_first_token_seconds", "histogram", "Time from upstream call to first streamed delta")
+metrics.describe("upstream_duration_seconds", "histogram", "Total upstream call time")
+metrics.describe("websocket_connections", "gauge", "Open WebSocket chat connections")
+metrics.describe("websocket_cancellations_total", "counter", "Chats cancelled by the client over WebSocket")
+metrics.describe("client_disconnects_total", "counter", "Requests abandoned by the client before their response finished")
+metrics.describe("upstream_cancellations_total", "counter", "Upstream generations aborted because nobody was waiting for them")
+metrics.describe("log_records_dropped_total", "counter", "Log records dropped because the log queue was full")
+metrics.describe("connections_rejected_total", "counter", "Connections turned away with 503 because every handler was busy")
+metrics.describe("upstream_tokens_per_second", "histogram", "Streamed deltas per second after the first one",
+                 buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+class Overloaded(Exception):
+    """Raised when a chat can't get an upstream slot before its deadline"""
+    def __init__(self, message: str, retry_after: int, reason: Optional[str] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+    
+    def __reduce__(self):
+        # Keep every field when raised in the shared state process and re-raised in a worker
+        return Overloaded, (str(self), self.retry_after, self.reason)
+
+class ClientDisconnected(Exception):
+    """Raised when the client went away before its response was ready"""
+
+def close_iterator(iterator: Iterator):
+    """Close a generator early so its cleanup (and the upstream call behind it) runs now"""
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+class Cancellation:
+    """Set when a buffered chat's client disconnects, ending its admission wait or subscription early"""
+    def __init__(self):
+        self.ticket = uuid.uuid4().hex
+        self.event = threading.Event()
+        # Another request joined the upstream call this one started, so that call has to go ahead regardless
+        self.shared = False
+        self.lock = threading.Lock()
+    
+    def is_set(self) -> bool:
+        return self.event.is_set()
+    
+    def set(self):
+        with self.lock:
+            self.event.set()
+            if self.shared:
+                return
+        admission.cancel(self.ticket)
+    
+    def share(self) -> bool:
+        """Mark the call as needed by other requests too; False if it's already being cancelled"""
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.shared = True
+            return True
+
+class ClientWatcher:
+    """Polls a client's connection on its own thread while its chat waits, cancelling the chat if it leaves"""
+    def __init__(self, disconnected: Callable[[], bool], cancel: Optional[Cancellation] = None):
+        self.disconnected = disconnected
+        self.cancel = cancel if cancel is not None else Cancellation()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+    
+    def __enter__(self) -> Cancellation:
+        self.thread = threading.Thread(target=self._run, name="client-watcher", daemon=True)
+        self.thread.start()
+        return self.cancel
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+    
+    def stop(self):
+        """Stop watching, returning once the watcher can no longer touch the connection"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+    
+    def _run(self):
+        while not self.stopped.wait(CONFIG["DISCONNECT_CHECK_INTERVAL"]):
+            if self.disconnected():
+                self.cancel.set()
+                return
+
+class AdmissionController:
+    """Bounded upstream concurrency behind a bounded, deadline-aware wait queue"""
+    def __init__(self, max_concurrent: int, max_queued: int, max_wait: float):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        # Moving average of how long a call holds its slot, used to predict queue waits
+        self.avg_call_time = 5.0
+        self.tickets: Dict[str, bool] = {}  # Ticket of each waiting chat that has one -> cancelled
+        self.cond = threading.Condition()
+    
+    def _expected_wait(self, position: int) -> float:
+        return position / self.max_concurrent * self.avg_call_time
+    
+    def _reject(self, reason: str, message: str) -> Overloaded:
+        metrics.inc("admission_rejections_total", reason=reason)
+        retry_after = max(1, math.ceil(self._expected_wait(self.waiting + 1)))
+        return Overloaded(message, retry_after, reason)
+    
+    def acquire(self, deadline: Optional[float] = None, ticket: Optional[str] = None) -> Optional[float]:
+        """Take an upstream slot, waiting until `deadline` (monotonic) at most; returns the time queued, if any.
+        
+        A chat waiting under `ticket` gives up with ClientDisconnected once cancel(ticket) is called.
+        """
+        started = time.monotonic()
+        deadline = min(deadline or math.inf, started + self.max_wait)
+        with self.cond:
+            if self.active < self.max_concurrent and self.waiting == 0:
+                self.active += 1
+                return None
+            if self.waiting >= self.max_queued:
+                raise self._reject("queue_full", "Server is busy, please retry later")
+            # Shed now rather than make the client wait for a slot it won't get in time
+            if started + self._expected_wait(self.waiting + 1) > deadline:
+                raise self._reject("deadline", "Server is busy, please retry later")
+            
+            self.waiting += 1
+            metrics.inc("upstream_queue_depth")
+            if ticket is not None:
+                self.tickets[ticket] = False
+            try:
+                while self.active >= self.max_concurrent:
+                    if ticket is not None and self.tickets[ticket]:
+                        raise ClientDisconnected("Client disconnected while queued for the AI service")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._reject("timeout", "Timed out waiting for the AI service")
+                    self.cond.wait(remaining)
+                self.active += 1
+            finally:
+                self.tickets.pop(ticket, None)
+                if self.active < self.max_concurrent:
+                    # A waiter leaving early may have taken the wake-up meant for a free slot, pass it on
+                    self.cond.notify()
+                self.waiting -= 1
+                metrics.inc("upstream_queue_depth", -1)
+                metrics.observe("upstream_queue_wait_seconds", time.monotonic() - started)
+            return time.monotonic() - started
+    
+    def release(self, call_time: Optional[float]):
+        """Free a slot and fold the call's duration (None if it never ran) into the wait estimate"""
+        with self.cond:
+            self.active -= 1
+            if call_time is not None:
+                self.avg_call_time = 0.8 * self.avg_call_time + 0.2 * call_time
+            self.cond.notify()
+    
+    def cancel(self, ticket: str):
+        """End the wait of the chat queued under `ticket`, if it is still waiting"""
+        with self.cond:
+            if ticket in self.tickets:
+                self.tickets[ticket] = True
+                self.cond.notify_all()
+
+class SharedAdmission:
+    """A worker's handle on the supervisor's AdmissionController, recording queue metrics in this process"""
+    def __init__(self, remote):
+        self.remote = remote
+    
+    def acquire(self, deadline: Optional[float] = None, ticket: Optional[str] = None):
+        metrics.inc("upstream_queue_depth")
+        try:
+            waited = self.remote.acquire(deadline, ticket)
+        except Overloaded as e:
+            metrics.inc("admission_rejections_total", reason=e.reason or "unknown")
+            raise
+        finally:
+            metrics.inc("upstream_queue_depth", -1)
+        if waited is not None:
+            metrics.observe("upstream_queue_wait_seconds", waited)
+    
+    def release(self, call_time: Optional[float]):
+        self.remote.release(call_time)
+    
+    def cancel(self, ticket: str):
+        self.remote.cancel(ticket)
+
+# Shared by every handler thread (and with WORKERS > 1 every process), so a burst of chats can't exhaust the provider quota
+admission = AdmissionController(CONFIG["MAX_UPSTREAM_CALLS"], CONFIG["MAX_QUEUED_CALLS"], CONFIG["MAX_QUEUE_WAIT"])
+
 class RateLimiter:
-    """Simple rate limiting implementation"""
+    """Token-bucket rate limiter with per-route limits and idle-IP eviction"""
     def __init__(self):
-        self.requests = defaultdict(list)
-        self.banned_ips = {}
+        # (ip, route) -> [tokens, last refill time]
+        self.buckets: Dict[Tuple[str, str], List[float]] = {}
+        self.banned_ips: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="rate-limit-sweeper", daemon=True)
+        self._sweeper.start()
+    
+    def _route_limit(self, route: Optional[str]) -> Tuple[str, int]:
+        """Pick the bucket scope and requests-per-minute limit for a route"""
+        routes = CONFIG["RATE_LIMIT"].get("ROUTES", {})
+        if route in routes:
+            return route, routes[route]
+        return "*", CONFIG["RATE_LIMIT"]["REQUESTS_PER_MINUTE"]
     
-    def check_rate_limit(self, ip: str) -> Tuple[bool, Optional[str]]:
+    def check_rate_limit(self, ip: str, route: Optional[str] = None) -> Tuple[bool, Optional[str]]:
         """Check if IP is rate limited"""
-        current_time = time.time()
+        current_time = time.monotonic()
+        scope, limit = self._route_limit(route)
         
-        # Check if IP is banned
-        if ip in self.banned_ips:
-            if current_time < self.banned_ips[ip]:
-                return False, f"Too many requests. Try again after {int(self.banned_ips[ip] - current_time)} seconds"
-            del self.banned_ips[ip]
+        with self.lock:
+            # Check if IP is banned
+            banned_until = self.banned_ips.get(ip)
+            if banned_until is not None:
+                if current_time < banned_until:
+                    return False, f"Too many requests. Try again after {int(banned_until - current_time)} seconds"
+                del self.banned_ips[ip]
+            
+            # Refill the bucket at `limit` tokens per minute, capped at `limit`
+            bucket = self.buckets.get((ip, scope))
+            if bucket is None:
+                bucket = self.buckets[(ip, scope)] = [float(limit), current_time]
+            else:
+                bucket[0] = min(float(limit), bucket[0] + (current_time - bucket[1]) * limit / 60)
+                bucket[1] = current_time
+            
+            if bucket[0] < 1:
+                # Ban the IP
+                self.banned_ips[ip] = current_time + CONFIG["RATE_LIMIT"]["BAN_TIME"]
+                return False, "Too many requests. You have been temporarily banned."
+            
+            bucket[0] -= 1
+            return True, None
+    
+    def evict_idle(self):
+        """Drop expired bans and buckets of IPs that stopped sending"""
+        current_time = time.monotonic()
+        idle_timeout = CONFIG["RATE_LIMIT"]["IDLE_TIMEOUT"]
+        with self.lock:
+            for ip in [ip for ip, until in self.banned_ips.items() if until <= current_time]:
+                del self.banned_ips[ip]
+            for key in [key for key, bucket in self.buckets.items() if current_time - bucket[1] > idle_timeout]:
+                del self.buckets[key]
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(CONFIG["RATE_LIMIT"]["SWEEP_INTERVAL"])
+            self.evict_idle()
+
+class ResponseCache:
+    """LRU + TTL cache of full AI responses with an optional SQLite backing store"""
+    def __init__(self, ttl: float, max_bytes: int, disk_path: Optional[str] = None,
+                 disk_max_rows: int = 10000, disk_prune_interval: float = 300):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> (response, expires_at, size)
+        self.entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk_max_rows = disk_max_rows
+        self.disk_prune_interval = disk_prune_interval
+        self.disk_rows = 0  # Rows on disk as of the last prune plus the puts since, an upper bound for this process
+        self.next_prune = 0.0
+        self.db = self._open_disk_store(disk_path) if disk_path else None
+    
+    def _open_disk_store(self, disk_path: str) -> sqlite3.Connection:
+        """Open the on-disk store and drop entries that expired while the server was down"""
+        db = sqlite3.connect(disk_path, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT, expires_at REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        self._prune_disk(db)
+        return db
+    
+    def _prune_disk(self, db: sqlite3.Connection):
+        """Delete expired rows, then the ones closest to expiring until the store is within DISK_MAX_ROWS"""
+        db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        rows = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if rows > self.disk_max_rows:
+            db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires_at LIMIT ?)",
+                       (rows - self.disk_max_rows,))
+            rows = self.disk_max_rows
+        db.commit()
+        self.disk_rows = rows
+        self.next_prune = time.monotonic() + self.disk_prune_interval
+    
+    @classmethod
+    def from_config(cls) -> "ResponseCache":
+        """The cache described by CONFIG["CACHE"], for one process or for every worker"""
+        settings = CONFIG["CACHE"]
+        return cls(settings["TTL"], settings["MAX_BYTES"], settings["DISK_PATH"],
+                   settings["DISK_MAX_ROWS"], settings["DISK_PRUNE_INTERVAL"])
+    
+    @staticmethod
+    def make_key(model: str, params: Dict, messages: List[Dict]) -> str:
+        """Hash everything that influences the upstream answer"""
+        payload = json.dumps({"model": model, "params": params, "messages": messages}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response, or None on a miss"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    return entry[0]
+                self._remove(key)
+            
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT response, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            self._store(key, row[0], row[1])
+            return row[0]
+    
+    def put(self, key: str, response: str):
+        """Cache a complete response"""
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._store(key, response, expires_at)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, response, expires_at))
+                self.db.commit()
+                self.disk_rows += 1
+                if self.disk_rows > self.disk_max_rows or time.monotonic() >= self.next_prune:
+                    self._prune_disk(self.db)
+    
+    def _store(self, key: str, response: str, expires_at: float):
+        size = sys.getsizeof(response) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (response, expires_at, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+    
+    def _remove(self, key: str):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+class Flight:
+    """One upstream response fanned out to every request waiting on it"""
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.waiters = 1
+        self.subscribers = 1  # Waiters still listening, the call is cancelled when this reaches zero
+        self.cancelled = threading.Event()
+        self.starter: Optional[Cancellation] = None  # Cancellation of the request that started the call
+        self.cond = threading.Condition()
+    
+    def publish(self, delta: str):
+        with self.cond:
+            self.chunks.append(delta)
+            self.cond.notify_all()
+    
+    def finish(self, error: Optional[Exception] = None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+    
+    def subscribe(self, cancel: Optional[Cancellation] = None) -> Iterator[str]:
+        """Yield every delta from the start, then raise the upstream error if there was one"""
+        position = 0
+        while True:
+            with self.cond:
+                while position >= len(self.chunks) and not self.done:
+                    if cancel is not None and cancel.is_set():
+                        raise ClientDisconnected("Client disconnected while waiting for the response")
+                    self.cond.wait(CONFIG["DISCONNECT_CHECK_INTERVAL"] if cancel is not None else None)
+                new_chunks = self.chunks[position:]
+                position += len(new_chunks)
+                finished = self.done and position >= len(self.chunks)
+            yield from new_chunks
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+class SingleFlight:
+    """Coalesce concurrent identical upstream calls into a single call"""
+    def __init__(self):
+        self.flights: Dict[str, Flight] = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+    
+    def join(self, key: str, start: Callable[[], Iterator[str]],
+             cancel: Optional[Cancellation] = None) -> Tuple[Iterator[str], bool]:
+        """Subscribe to the call for `key`, starting it if none is in flight; returns (deltas, coalesced)"""
+        with self.lock:
+            flight = self.flights.get(key)
+            # A call whose starter left while it was still queued is about to fail, start a fresh one instead
+            if flight is not None and (flight.starter is None or flight.starter.share()):
+                flight.waiters += 1
+                flight.subscribers += 1
+                self.coalesced += 1
+                metrics.inc("coalesced_requests_total")
+                return self._subscribe(key, flight, cancel), True
+            flight = self.flights[key] = Flight()
+            flight.starter = cancel
         
-        # Clean up old requests
-        self.requests[ip] = [t for t in self.requests[ip] if current_time - t < 60]
+        # Start the call here so admission errors reach the caller before it answers its client
+        try:
+            deltas = start()
+        except Exception as e:
+            flight.finish(e)
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            raise
         
-        # Check current rate
-        if len(self.requests[ip]) >= CONFIG["RATE_LIMIT"]["REQUESTS_PER_MINUTE"]:
-            # Ban the IP
-            self.banned_ips[ip] = current_time + CONFIG["RATE_LIMIT"]["BAN_TIME"]
-            return False, "Too many requests. You have been temporarily banned."
+        # The upstream is drained on its own thread so one waiter going away can't stall the rest
+        threading.Thread(target=self._run, args=(key, flight, deltas), name="single-flight", daemon=True).start()
+        return self._subscribe(key, flight, cancel), False
+    
+    def _subscribe(self, key: str, flight: Flight, cancel: Optional[Cancellation] = None) -> Iterator[str]:
+        """Follow the flight, cancelling the upstream call if the last waiter stops listening early"""
+        finished = False
+        try:
+            yield from flight.subscribe(cancel)
+            finished = True
+        finally:
+            if not finished:
+                with self.lock:
+                    flight.subscribers -= 1
+                    if flight.subscribers == 0 and not flight.done:
+                        flight.cancelled.set()
+                        # Later identical requests must start a fresh call rather than join this one
+                        if self.flights.get(key) is flight:
+                            del self.flights[key]
+    
+    def _run(self, key: str, flight: Flight, deltas: Iterator[str]):
+        try:
+            for delta in deltas:
+                if flight.cancelled.is_set():
+                    break
+                flight.publish(delta)
+            if flight.cancelled.is_set():
+                flight.finish(ClientDisconnected("Every waiting client disconnected"))
+            else:
+                flight.finish()
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            deltas.close()
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            if flight.waiters > 1:
+                logging.info("Coalesced %d request(s) into one upstream call", flight.waiters - 1)
+
+class Upstream:
+    """One provider/key pair with its health and latency history"""
+    def __init__(self, name: str, client: InferenceClient, model: Optional[str] = None):
+        self.name = name
+        self.client = client
+        self.model = model or CONFIG["MODEL_NAME"]
+        self.ttft_samples = deque(maxlen=100)
+        self.avg_ttft = 1.0
+        self.in_flight = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.lock = threading.Lock()
+    
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+    
+    def score(self) -> float:
+        """Expected time to first token, penalised by the calls already running here"""
+        return self.avg_ttft * (1 + self.in_flight)
+    
+    def hedge_delay(self) -> float:
+        """How long to wait for a first token before hedging to another upstream"""
+        with self.lock:
+            samples = sorted(self.ttft_samples)
+        if len(samples) < 20:
+            return CONFIG["HEDGE"]["MIN_DELAY"]
+        quantile = samples[min(len(samples) - 1, int(CONFIG["HEDGE"]["QUANTILE"] * len(samples)))]
+        return max(CONFIG["HEDGE"]["MIN_DELAY"], quantile)
+    
+    def record_success(self, ttft: float):
+        with self.lock:
+            self.ttft_samples.append(ttft)
+            self.avg_ttft = 0.8 * self.avg_ttft + 0.2 * ttft
+            self.failures = 0
+    
+    def record_failure(self, error: Exception):
+        """Count an error, benching the upstream on a 429 or after repeated failures"""
+        response = getattr(error, 'response', None)
+        rate_limited = getattr(response, 'status_code', None) == 429
+        with self.lock:
+            self.failures += 1
+            if rate_limited or self.failures >= CONFIG["UPSTREAM_HEALTH"]["MAX_FAILURES"]:
+                cooldown = CONFIG["UPSTREAM_HEALTH"]["COOLDOWN"]
+                try:
+                    cooldown = float(response.headers['Retry-After'])
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    pass
+                self.cooldown_until = time.monotonic() + cooldown
+                self.failures = 0
+                logging.warning("Upstream %s benched for %gs after: %s", self.name, cooldown, error)
+        metrics.inc("upstream_attempts_total", upstream=self.name, outcome="rate_limited" if rate_limited else "error")
+    
+    def open(self, messages: List[Dict]) -> Iterator[str]:
+        """Start a streaming completion and yield its deltas"""
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            **CONFIG["MODEL_PARAMS"]
+        )
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Drop the upstream connection if the caller stopped early, instead of draining max_tokens
+            close_iterator(response)
+
+class UpstreamPool:
+    """Latency-weighted routing over several upstreams with failover and optional hedging"""
+    def __init__(self, upstreams: List[Upstream]):
+        self.upstreams = upstreams
+    
+    def choose(self, exclude: List[Upstream]) -> Optional[Upstream]:
+        """Pick an upstream not yet tried, favouring healthy, fast and idle ones"""
+        candidates = [upstream for upstream in self.upstreams if upstream not in exclude]
+        if not candidates:
+            return None
+        # If everything is benched, trying one beats failing outright
+        healthy = [upstream for upstream in candidates if upstream.is_healthy()] or candidates
+        return random.choices(healthy, weights=[1 / max(upstream.score(), 1e-3) for upstream in healthy])[0]
+    
+    def stream(self, messages: List[Dict]) -> Iterator[str]:
+        """Yield deltas from the best upstream, failing over if one errors before its first token"""
+        if CONFIG["HEDGE"]["ENABLED"] and len(self.upstreams) > 1:
+            yield from self._stream_hedged(messages)
+            return
+        
+        tried = []
+        while True:
+            upstream = self.choose(tried)
+            tried.append(upstream)
+            started = time.perf_counter()
+            streaming = False
+            with upstream.lock:
+                upstream.in_flight += 1
+            deltas = upstream.open(messages)
+            try:
+                for delta in deltas:
+                    if not streaming:
+                        streaming = True
+                        upstream.record_success(time.perf_counter() - started)
+                    yield delta
+                metrics.inc("upstream_attempts_total", upstream=upstream.name, outcome="ok")
+                return
+            except Exception as e:
+                upstream.record_failure(e)
+                # Text already sent can't be taken back, so only fail over before the first token
+                if streaming or len(tried) == len(self.upstreams):
+                    raise
+                logging.warning("Upstream %s failed, failing over: %s", upstream.name, e)
+            finally:
+                deltas.close()
+                with upstream.lock:
+                    upstream.in_flight -= 1
+    
+    def _stream_hedged(self, messages: List[Dict]) -> Iterator[str]:
+        """Race a second upstream against a slow first one and keep whichever starts first"""
+        events = queue.Queue()
+        attempts: List[Tuple[Upstream, threading.Event]] = []
         
-        # Record this request
-        self.requests[ip].append(current_time)
-        return True, None
+        def launch() -> bool:
+            upstream = self.choose([attempt[0] for attempt in attempts])
+            if upstream is None:
+                return False
+            cancel = threading.Event()
+            attempts.append((upstream, cancel))
+            threading.Thread(target=self._run_attempt, args=(len(attempts) - 1, upstream, messages, cancel, events),
+                             name="upstream-attempt", daemon=True).start()
+            return True
+        
+        launch()
+        running = 1
+        winner = None
+        hedge_at = time.perf_counter() + attempts[0][0].hedge_delay()
+        try:
+            while True:
+                timeout = None
+                if winner is None and len(attempts) <= CONFIG["HEDGE"]["MAX_HEDGES"]:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                try:
+                    index, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    if launch():
+                        running += 1
+                        metrics.inc("hedged_requests_total")
+                    hedge_at = time.perf_counter() + attempts[-1][0].hedge_delay()
+                    continue
+                
+                if winner is not None and index != winner:
+                    continue
+                if kind == "delta":
+                    if winner is None:
+                        winner = index
+                        for i, (_, cancel) in enumerate(attempts):
+                            if i != winner:
+                                cancel.set()
+                    yield payload
+                elif kind == "done":
+                    return
+                else:
+                    running -= 1
+                    if winner == index:
+                        raise payload
+                    if running == 0:
+                        if not launch():
+                            raise payload
+                        running += 1
+        finally:
+            for _, cancel in attempts:
+                cancel.set()
+    
+    def _run_attempt(self, index: int, upstream: Upstream, messages: List[Dict], cancel: threading.Event, events: queue.Queue):
+        started = time.perf_counter()
+        streaming = False
+        with upstream.lock:
+            upstream.in_flight += 1
+        try:
+            deltas = upstream.open(messages)
+            for delta in deltas:
+                if cancel.is_set():
+                    deltas.close()
+                    metrics.inc("upstream_attempts_total", upstream=upstream.name, outcome="cancelled")
+                    return
+                if not streaming:
+                    streaming = True
+                    upstream.record_success(time.perf_counter() - started)
+                events.put((index, "delta", delta))
+            metrics.inc("upstream_attempts_total", upstream=upstream.name, outcome="ok")
+            events.put((index, "done", None))
+        except Exception as e:
+            upstream.record_failure(e)
+            events.put((index, "error", e))
+        finally:
+            with upstream.lock:
+                upstream.in_flight -= 1
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, about four characters per token for English text"""
+    return len(text) // 4 + 1
+
+class SessionStore:
+    """Conversation history kept server-side in SQLite (WAL mode, one connection per thread)"""
+    def __init__(self, db_path: str, ttl: float):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.local = threading.local()
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                tokens INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_session ON messages (session_id, id);
+        """)
+    
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+        return db
+    
+    def create(self) -> str:
+        """Start a new session, clearing out expired ones while at it"""
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._db()
+        db.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+        db.execute("INSERT INTO sessions VALUES (?, ?)", (session_id, now))
+        return session_id
+    
+    def exists(self, session_id: str) -> bool:
+        return self._db().execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+    
+    def history(self, session_id: str, token_budget: Optional[int] = None) -> List[Dict]:
+        """Return the newest messages that fit in the token budget, oldest first"""
+        rows = self._db().execute(
+            "SELECT role, content, tokens FROM messages WHERE session_id = ? ORDER BY id DESC", (session_id,))
+        messages = []
+        used = 0
+        for role, content, tokens in rows:
+            if token_budget is not None and used + tokens > token_budget:
+                break
+            used += tokens
+            messages.append({"role": role, "content": content})
+        messages.reverse()
+        # Never start the history halfway through an exchange
+        if messages and messages[0]["role"] == "assistant":
+            messages.pop(0)
+        return messages
+    
+    def append_turn(self, session_id: str, user_message: str, response: str):
+        """Store one user message and the assistant's reply"""
+        db = self._db()
+        with db:
+            db.execute("BEGIN")
+            db.executemany("INSERT INTO messages (session_id, role, content, tokens) VALUES (?, ?, ?, ?)", [
+                (session_id, "user", user_message, estimate_tokens(user_message)),
+                (session_id, "assistant", response, estimate_tokens(response)),
+            ])
+            db.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id))
+    
+    def delete(self, session_id: str) -> bool:
+        return self._db().execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0
 
 class AIClient:
     """Wrapper for AI client operations"""
     def __init__(self):
-        self.api_key = self._load_api_key()
-        self.client = None
+        self.upstream_settings = self._load_upstream_settings()
+        self.upstreams: Optional[UpstreamPool] = None
+        self.session = None
+        self.lock = threading.Lock()
+        self.cache = None
+        if CONFIG["CACHE"]["ENABLED"]:
+            self.cache = ResponseCache.from_config()
+        self.flights = SingleFlight() if CONFIG["COALESCE_REQUESTS"] else None
+        self.sessions = None
+        if CONFIG["SESSIONS"]["ENABLED"]:
+            self.sessions = SessionStore(CONFIG["SESSIONS"]["DB_PATH"], CONFIG["SESSIONS"]["TTL"])
         
-    def _load_api_key(self) -> str:
+    def _load_api_key(self, key_file: str) -> str:
         """Load API key from file"""
         try:
-            if os.path.exists(CONFIG["API_KEY_FILE"]):
-                with open(CONFIG["API_KEY_FILE"], 'r') as file:
+            if os.path.exists(key_file):
+                with open(key_file, 'r') as file:
                     key = file.readline().strip()
                     if not key:
                         raise ValueError("API key file is empty")
                     return key
-            raise FileNotFoundError(f"API key file not found at {CONFIG['API_KEY_FILE']}")
+            raise FileNotFoundError(f"API key file not found at {key_file}")
         except Exception as e:
             logging.error(f"Failed to load API key: {str(e)}")
             raise
+    
+    def _load_upstream_settings(self) -> List[Dict]:
+        """Resolve every configured upstream's API key once, up front"""
+        settings = []
+        for upstream in CONFIG["UPSTREAMS"]:
+            upstream = dict(upstream)
+            if "api_key" not in upstream:
+                upstream["api_key"] = self._load_api_key(upstream.pop("api_key_file", None) or CONFIG["API_KEY_FILE"])
+            settings.append(upstream)
+        return settings
         
     def initialize_client(self):
-        """Initialize the inference client"""
-        if not self.client:
-            self.client = InferenceClient(
-                provider="nebius",
-                api_key=self.api_key
-            )
-            logging.info("AI client initialized")
+        """Initialize the inference clients"""
+        with self.lock:
+            if not self.upstreams:
+                self.session = self._create_http_session()
+                upstreams = []
+                for settings in self.upstream_settings:
+                    if settings.get("base_url"):
+                        client = InferenceClient(base_url=settings["base_url"], api_key=settings["api_key"])
+                    else:
+                        client = InferenceClient(provider=settings["provider"], api_key=settings["api_key"])
+                    name = settings.get("name") or settings.get("provider") or settings["base_url"]
+                    upstreams.append(Upstream(name, client, settings.get("model")))
+                self.upstreams = UpstreamPool(upstreams)
+                logging.info(f"AI client initialized ({', '.join(upstream.name for upstream in upstreams)})")
     
-    def get_response(self, user_message: str) -> str:
-        """Get AI response for user message"""
+    def _create_http_session(self):
+        """Route every upstream call through one pooled keep-alive client, or None if that isn't possible"""
+        try:
+            # huggingface_hub 1.x talks to providers through a shared httpx client made by this factory
+            import httpx
+            from huggingface_hub import set_client_factory
+        except ImportError:
+            pass
+        else:
+            limits = httpx.Limits(max_connections=CONFIG["UPSTREAM_POOL_SIZE"],
+                                  max_keepalive_connections=CONFIG["UPSTREAM_POOL_SIZE"])
+            client = httpx.Client(limits=limits, follow_redirects=True, timeout=None)
+            set_client_factory(lambda: client)
+            return client
+        
+        try:
+            # Older releases use requests, swapped out through configure_http_backend
+            import requests
+            from requests.adapters import HTTPAdapter
+            from huggingface_hub import configure_http_backend
+        except ImportError as e:
+            logging.warning("Upstream connection pooling and pre-warming are off, this huggingface_hub "
+                            "has no way to share its HTTP client (%s)", e)
+            return None
+        
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=CONFIG["UPSTREAM_POOL_SIZE"])
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        configure_http_backend(backend_factory=lambda: session)
+        return session
+    
+    def prewarm(self):
+        """Open the upstream connection so the first chat skips the TCP/TLS handshake"""
+        self.initialize_client()
+        if self.session is None:
+            logging.warning("Skipping upstream pre-warm, the HTTP client isn't pooled")
+            return
+        urls = {settings.get("base_url") or CONFIG["PREWARM_URL"] for settings in self.upstream_settings}
+        for url in urls:
+            try:
+                self.session.head(url, timeout=5)
+                logging.info("Upstream connection pre-warmed (%s)", url)
+            except Exception as e:
+                logging.warning("Pre-warm of %s failed: %s", url, e)
+    
+    def _build_messages(self, user_message: str, history: Optional[List[Dict]] = None) -> List[Dict]:
+        """Wrap the user message in the default conversation context and any session history"""
+        return [{"role": "user", "content": f"{CONFIG['DEFAULT_CONTEXT']}"},{"role": "assistant", "content": f"{CONFIG['DEFAULT_CONTEXT_TWO']}"}] + (history or []) + [{"role": "user", "content": f"{user_message}"}]
+    
+    def stream_response(self, user_message: str, deadline: Optional[float] = None,
+                        history: Optional[List[Dict]] = None,
+                        cancel: Optional[Cancellation] = None) -> Iterator[str]:
+        """Admit the call to the upstream queue and return its deltas, raising on upstream errors"""
+        deltas = self._upstream_deltas(user_message, deadline, history, cancel)
+        # Run up to admission now, so Overloaded is raised before the caller starts its response
+        next(deltas)
+        return deltas
+    
+    def _upstream_deltas(self, user_message: str, deadline: Optional[float],
+                         history: Optional[List[Dict]],
+                         cancel: Optional[Cancellation] = None) -> Iterator[Optional[str]]:
         if not user_message.strip():
-            return "Please provide a valid question or prompt."
-                
-        messages = [{"role": "user", "content": f"{CONFIG['DEFAULT_CONTEXT']}"},{"role": "assistant", "content": f"{CONFIG['DEFAULT_CONTEXT_TWO']}"},{"role": "user", "content": f"{user_message}"}]
+            yield None
+            yield "Please provide a valid question or prompt."
+            return
         
+        self.initialize_client()
+        admission.acquire(deadline, cancel.ticket if cancel is not None else None)
+        if cancel is not None and not cancel.share():
+            # The client left just as the slot came free, don't spend it on a call nobody will read
+            admission.release(None)
+            raise ClientDisconnected("Client disconnected while queued for the AI service")
+        metrics.inc("upstream_in_flight")
+        started = time.perf_counter()
+        first_delta_at = None
+        deltas = 0
+        stream = self.upstreams.stream(self._build_messages(user_message, history))
         try:
-            self.initialize_client()
-            response = self.client.chat.completions.create(
-                model=CONFIG["MODEL_NAME"],
-                messages=messages,
-                **CONFIG["MODEL_PARAMS"]
-            )
-            
-            full_response = ""
-            for chunk in response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    full_response += chunk.choices[0].delta.content
-            return full_response
-            
+            # Started generators always reach `finally`, so the slot is released even if never iterated
+            yield None
+            for delta in stream:
+                if first_delta_at is None:
+                    first_delta_at = time.perf_counter()
+                    metrics.observe("upstream_time_to_first_token_seconds", first_delta_at - started)
+                deltas += 1
+                yield delta
+        except GeneratorExit:
+            # Closed before the end: nobody wants the rest of this response
+            metrics.inc("upstream_cancellations_total")
+            raise
+        except Exception:
+            metrics.inc("upstream_errors_total")
+            raise
+        finally:
+            stream.close()
+            finished = time.perf_counter()
+            admission.release(finished - started)
+            metrics.inc("upstream_in_flight", -1)
+            metrics.observe("upstream_duration_seconds", finished - started)
+            if first_delta_at is not None and deltas > 1 and finished > first_delta_at:
+                metrics.observe("upstream_tokens_per_second", (deltas - 1) / (finished - first_delta_at))
+    
+    def open_stream(self, user_message: str, deadline: Optional[float] = None, session_id: Optional[str] = None,
+                    cancel: Optional[Cancellation] = None) -> Tuple[Iterator[str], Dict[str, str]]:
+        """Return the response deltas and headers describing where they come from"""
+        history = None
+        if session_id is not None:
+            if self.sessions is None or not self.sessions.exists(session_id):
+                raise ValueError("Unknown session")
+            history = self.sessions.history(session_id, CONFIG["SESSIONS"]["HISTORY_TOKEN_BUDGET"])
+        
+        deltas, headers = self._open_stream(user_message, deadline, history, cancel)
+        if session_id is not None:
+            deltas = self._session_stream(session_id, user_message, deltas)
+        return deltas, headers
+    
+    def _open_stream(self, user_message: str, deadline: Optional[float], history: Optional[List[Dict]],
+                     cancel: Optional[Cancellation] = None) -> Tuple[Iterator[str], Dict[str, str]]:
+        key = ResponseCache.make_key(CONFIG["MODEL_NAME"], CONFIG["MODEL_PARAMS"], self._build_messages(user_message, history))
+        headers = {}
+        
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            headers["X-Cache"] = "MISS" if cached is None else "HIT"
+            metrics.inc("response_cache_requests_total", result=headers["X-Cache"].lower())
+            if cached is not None:
+                return iter([cached]), headers
+        
+        def start() -> Iterator[str]:
+            deltas = self.stream_response(user_message, deadline, history, cancel)
+            return deltas if self.cache is None else self._cache_stream(key, deltas)
+        
+        if self.flights is None:
+            return start(), headers
+        deltas, coalesced = self.flights.join(key, start, cancel)
+        headers["X-Coalesced"] = "1" if coalesced else "0"
+        return deltas, headers
+    
+    def _session_stream(self, session_id: str, user_message: str, deltas: Iterator[str]) -> Iterator[str]:
+        """Pass deltas through and add the exchange to the session once the stream completes"""
+        parts = []
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield delta
+        finally:
+            close_iterator(deltas)
+        self.sessions.append_turn(session_id, user_message, "".join(parts))
+    
+    def _cache_stream(self, key: str, deltas: Iterator[str]) -> Iterator[str]:
+        """Pass deltas through and cache the response once the stream completes"""
+        parts = []
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield delta
+        finally:
+            close_iterator(deltas)
+        self.cache.put(key, "".join(parts))
+    
+    def complete(self, user_message: str, timings: Optional[Dict[str, float]] = None,
+                 deadline: Optional[float] = None, session_id: Optional[str] = None,
+                 disconnected: Optional[Callable[[], bool]] = None) -> Tuple[str, Dict[str, str]]:
+        """Get the full AI response and the headers describing where it came from"""
+        headers = {}
+        timings = timings if timings is not None else {}
+        started = time.perf_counter()
+        # Watch the connection from the start, so a client that leaves while queued gives up its place
+        watcher = ClientWatcher(disconnected) if disconnected is not None else contextlib.nullcontext()
+        try:
+            with watcher as cancel:
+                deltas, headers = self.open_stream(user_message, deadline, session_id, cancel)
+                try:
+                    parts = self._collect(deltas, cancel, started, timings)
+                finally:
+                    close_iterator(deltas)
+            timings["upstream"] = time.perf_counter() - started
+            return "".join(parts), headers
+        except (Overloaded, ValueError, ClientDisconnected):
+            raise
         except Exception as e:
-            logging.error(f"AI Error: {str(e)}")
-            return f"Sorry, I encountered an error processing your request: {str(e)}"
+            logging.error("AI Error: %s", e)
+            return f"Sorry, I encountered an error processing your request: {str(e)}", headers
+    
+    @staticmethod
+    def _collect(deltas: Iterator[str], cancel: Optional[Cancellation],
+                 started: float, timings: Dict[str, float]) -> List[str]:
+        """Buffer the deltas, stopping once the client watching for them has gone"""
+        parts = []
+        for delta in deltas:
+            if not parts:
+                timings["ttft"] = time.perf_counter() - started
+            parts.append(delta)
+            if cancel is not None and cancel.is_set():
+                raise ClientDisconnected("Client disconnected while the response was buffered")
+        return parts
+    
+    def complete_batch(self, messages: List, deadline: Optional[float] = None,
+                       disconnected: Optional[Callable[[], bool]] = None) -> Iterator[Dict]:
+        """Run a batch of messages with bounded concurrency, yielding per-item results in order"""
+        executor = ThreadPoolExecutor(max_workers=max(1, min(CONFIG["BATCH"]["CONCURRENCY"], len(messages))),
+                                      thread_name_prefix="batch")
+        cancel = threading.Event()
+        try:
+            futures = [executor.submit(self._batch_item, index, message, deadline, cancel) for index, message in enumerate(messages)]
+            for future in futures:
+                while True:
+                    try:
+                        result = future.result(timeout=CONFIG["DISCONNECT_CHECK_INTERVAL"])
+                        break
+                    except FutureTimeoutError:
+                        if disconnected is not None and disconnected():
+                            raise ClientDisconnected("Client disconnected during batch")
+                yield result
+        finally:
+            # Don't start items nobody is waiting for if the client went away, and stop the running ones
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _batch_item(self, index: int, message, deadline: Optional[float], cancel: threading.Event) -> Dict:
+        if not isinstance(message, str) or not message.strip():
+            return {"index": index, "status": 400, "error": "Message is required"}
+        try:
+            deltas, headers = self.open_stream(message.strip(), deadline)
+            try:
+                parts = []
+                for delta in deltas:
+                    if cancel.is_set():
+                        return {"index": index, "status": 499, "error": "Batch cancelled"}
+                    parts.append(delta)
+            finally:
+                close_iterator(deltas)
+            return {"index": index, "status": 200, "response": "".join(parts), "cached": headers.get("X-Cache") == "HIT"}
+        except Overloaded as e:
+            return {"index": index, "status": 503, "error": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            logging.error("AI Error: %s", e)
+            return {"index": index, "status": 502, "error": f"Sorry, I encountered an error processing your request: {str(e)}"}
+    
+    def get_response(self, user_message: str) -> str:
+        """Get AI response for user message"""
+        return self.complete(user_message)[0]
+
+class StaticAsset:
+    """A static file with its validators and, if small enough, its cached bytes"""
+    def __init__(self, path: str, stat: os.stat_result, content_type: str):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.content_type = content_type
+        self.etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        self.gzip_etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-gzip"'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.content: Optional[bytes] = None
+        self.gzip_content: Optional[bytes] = None
+
+class StaticFileCache:
+    """In-memory static file cache, revalidated against the file's mtime and size"""
+    def __init__(self):
+        self.assets: Dict[str, StaticAsset] = {}
+        self.lock = threading.Lock()
+    
+    def get(self, path: str, content_type: str) -> Optional[StaticAsset]:
+        """Return the asset for path, reloading it if the file changed, or None if it doesn't exist"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        
+        with self.lock:
+            asset = self.assets.get(path)
+        if asset is not None and asset.mtime_ns == stat.st_mtime_ns and asset.size == stat.st_size:
+            return asset
+        
+        asset = self._load(path, stat, content_type)
+        with self.lock:
+            self.assets[path] = asset
+        return asset
+    
+    def _load(self, path: str, stat: os.stat_result, content_type: str) -> StaticAsset:
+        asset = StaticAsset(path, stat, content_type)
+        if stat.st_size > CONFIG["STATIC"]["MAX_CACHED_FILE_SIZE"]:
+            return asset
+        
+        with open(path, 'rb') as f:
+            asset.content = f.read()
+        if content_type in CONFIG["STATIC"]["GZIP_TYPES"] and len(asset.content) >= CONFIG["STATIC"]["GZIP_MIN_SIZE"]:
+            compressed = gzip.compress(asset.content, compresslevel=9)
+            if len(compressed) < len(asset.content):
+                asset.gzip_content = compressed
+        return asset
+
+static_files = StaticFileCache()
+
+class WebSocketClosed(Exception):
+    """The peer closed the WebSocket or sent something we can't accept"""
+    def __init__(self, code: int = 1000, reason: str = ""):
+        super().__init__(reason or f"WebSocket closed ({code})")
+        self.code = code
+
+class WebSocket:
+    """Minimal RFC 6455 server endpoint over a handler's rfile/wfile"""
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+    
+    def __init__(self, rfile, wfile, max_message_size: int):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.max_message_size = max_message_size
+        self.write_lock = threading.Lock()
+        self.closed = False
+    
+    @classmethod
+    def accept_key(cls, key: str) -> str:
+        """Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key"""
+        return base64.b64encode(hashlib.sha1((key + cls.GUID).encode()).digest()).decode()
+    
+    def _read_exact(self, size: int) -> bytes:
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise WebSocketClosed(1006, "Connection lost")
+        return data
+    
+    def _read_frame(self) -> Tuple[bool, int, bytes]:
+        first, second = self._read_exact(2)
+        if first & 0x70:
+            raise WebSocketClosed(1002, "Unexpected extension bits")
+        if not second & 0x80:
+            raise WebSocketClosed(1002, "Client frames must be masked")
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read_exact(8))[0]
+        if length > self.max_message_size:
+            raise WebSocketClosed(1009, "Message too big")
+        
+        mask = self._read_exact(4)
+        payload = self._read_exact(length)
+        if length:
+            # Unmask the whole payload in one big-integer XOR instead of byte by byte
+            key = int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+            payload = (int.from_bytes(payload, 'big') ^ key).to_bytes(length, 'big')
+        return bool(first & 0x80), first & 0x0F, payload
+    
+    def receive(self) -> str:
+        """Return the next text message, answering pings and reassembling fragments on the way"""
+        message: Optional[bytearray] = None
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == self.CLOSE:
+                code = struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else 1000
+                self.close(code)
+                raise WebSocketClosed(code)
+            if opcode == self.PING:
+                self.send(self.PONG, payload)
+                continue
+            if opcode == self.PONG:
+                continue
+            if opcode == self.BINARY:
+                raise WebSocketClosed(1003, "Only text messages are supported")
+            if (opcode == self.TEXT) == (message is not None):
+                raise WebSocketClosed(1002, "Unexpected continuation frame")
+            
+            message = (message or bytearray()) + payload
+            if len(message) > self.max_message_size:
+                raise WebSocketClosed(1009, "Message too big")
+            if fin:
+                try:
+                    return message.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise WebSocketClosed(1007, "Invalid UTF-8")
+    
+    def send(self, opcode: int, payload: bytes = b""):
+        """Write one unfragmented frame"""
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.write_lock:
+            if self.closed:
+                raise WebSocketClosed(1006, "Connection already closed")
+            self.wfile.write(header + payload)
+            if opcode == self.CLOSE:
+                self.closed = True
+    
+    def send_json(self, data: Dict):
+        self.send(self.TEXT, json.dumps(data).encode('utf-8'))
+    
+    def close(self, code: int = 1000):
+        """Send a close frame unless one already went out"""
+        try:
+            self.send(self.CLOSE, struct.pack('!H', code))
+        except (WebSocketClosed, OSError):
+            pass
+
+class ClientRegistry:
+    """Process-wide AIClient and RateLimiter shared by every handler thread"""
+    _lock = threading.Lock()
+    _ai_client: Optional[AIClient] = None
+    _rate_limiter: Optional[RateLimiter] = None
+    
+    @classmethod
+    def ai_client(cls) -> AIClient:
+        """Return the shared AI client, loading the API key on first use"""
+        if cls._ai_client is None:
+            with cls._lock:
+                if cls._ai_client is None:
+                    cls._ai_client = AIClient()
+        return cls._ai_client
+    
+    @classmethod
+    def rate_limiter(cls) -> RateLimiter:
+        """Return the shared rate limiter"""
+        if cls._rate_limiter is None:
+            with cls._lock:
+                if cls._rate_limiter is None:
+                    cls._rate_limiter = RateLimiter()
+        return cls._rate_limiter
+    
+    @classmethod
+    def use_shared_state(cls, state: "StateManager"):
+        """Point this process at the rate limiter, upstream admission and cache served by the supervisor"""
+        global admission
+        admission = SharedAdmission(state.admission())
+        with cls._lock:
+            cls._rate_limiter = state.rate_limiter()
+        if CONFIG["CACHE"]["ENABLED"]:
+            cls.ai_client().cache = state.response_cache()
+
+class StateManager(BaseManager):
+    """Serves one rate limiter, admission controller and response cache to every worker process over a local socket"""
+
+_shared_state: Dict[str, object] = {}
+
+def _shared_rate_limiter() -> RateLimiter:
+    if "rate_limiter" not in _shared_state:
+        _shared_state["rate_limiter"] = RateLimiter()
+    return _shared_state["rate_limiter"]
+
+def _shared_response_cache() -> ResponseCache:
+    if "response_cache" not in _shared_state:
+        _shared_state["response_cache"] = ResponseCache.from_config()
+    return _shared_state["response_cache"]
+
+def _shared_admission() -> AdmissionController:
+    if "admission" not in _shared_state:
+        _shared_state["admission"] = AdmissionController(CONFIG["MAX_UPSTREAM_CALLS"], CONFIG["MAX_QUEUED_CALLS"], CONFIG["MAX_QUEUE_WAIT"])
+    return _shared_state["admission"]
+
+StateManager.register("rate_limiter", callable=_shared_rate_limiter)
+StateManager.register("admission", callable=_shared_admission)
+StateManager.register("response_cache", callable=_shared_response_cache)
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
     """Custom HTTP request handler with AI integration"""
+    # Persistent connections; every response carries a Content-Length or is chunked
+    protocol_version = "HTTP/1.1"
+    timeout = CONFIG["KEEP_ALIVE"]["IDLE_TIMEOUT"]
+    # Headers and body go out as separate writes; with Nagle on, the second waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+    websocket_connections = 0
+    _websocket_lock = threading.Lock()
     
     def __init__(self, *args, ai_client: Optional[AIClient] = None, rate_limiter: Optional[RateLimiter] = None, **kwargs):
-        self.ai_client = ai_client or AIClient()
-        self.rate_limiter = rate_limiter or RateLimiter()
+        self.ai_client = ai_client or ClientRegistry.ai_client()
+        self.rate_limiter = rate_limiter or ClientRegistry.rate_limiter()
+        self.requests_served = 0
+        self.status_code = None
+        self.timings: Dict[str, float] = {}
         super().__init__(*args, **kwargs)
     
+    def handle_one_request(self):
+        """Serve one request and record its route, status and latency"""
+        self.command = None
+        self.status_code = None
+        self.timings = {}
+        # Restarted by parse_request once the request line is in, so keep-alive idle time isn't counted
+        self.request_started = time.perf_counter()
+        self.request_id = uuid.uuid4().hex[:16]
+        # A kept-alive connection waiting for its next request gives its worker back if the pool runs out
+        if self.requests_served and hasattr(self.server, 'connection_idle') and not self.server.connection_idle(self.connection):
+            self.close_connection = True
+            return
+        super().handle_one_request()
+        if self.command is None or self.status_code is None:
+            return
+        
+        route = self._metrics_route()
+        duration = time.perf_counter() - self.request_started
+        metrics.inc("http_requests_total", route=route, method=self.command, status=str(self.status_code))
+        metrics.observe("http_request_duration_seconds", duration, route=route)
+        if self.status_code >= 500:
+            metrics.inc("http_errors_total", route=route)
+        if CONFIG["LOGGING"]["ACCESS_LOG"]:
+            self._log_access(route, duration)
+    
+    def parse_request(self) -> bool:
+        """Parse the request line and headers, adopting a sane client-supplied X-Request-ID"""
+        self.request_started = time.perf_counter()
+        self.eof_probed = False
+        self.events_started = False
+        if hasattr(self.server, 'connection_busy'):
+            self.server.connection_busy(self.connection)
+        if not super().parse_request():
+            return False
+        request_id = self.headers.get('X-Request-ID', '')
+        if 0 < len(request_id) <= 64 and request_id.replace('-', '').isalnum():
+            self.request_id = request_id
+        return True
+    
+    def _log_access(self, route: str, duration: float):
+        """Queue a JSON access log line, keeping only a sample of high-volume outcomes"""
+        rates = CONFIG["LOGGING"]["SAMPLE_RATES"]
+        status = str(self.status_code)
+        rate = rates.get(status, rates.get(route, 1.0)) if self.status_code < 500 else 1.0
+        if rate < 1.0 and random.random() >= rate:
+            return
+        log_pipeline.access.info({
+            "time": time.time(),
+            "request_id": self.request_id,
+            "client": self.client_address[0],
+            "method": self.command,
+            "path": self.path,
+            "route": route,
+            "status": self.status_code,
+            "duration_ms": round(duration * 1000, 2),
+            "sample_rate": rate
+        })
+    
+    def log_request(self, code='-', size='-'):
+        """Requests are recorded by the access log once they finish"""
+    
+    def log_error(self, format: str, *args):
+        """Log protocol errors, leaving send_error's status notices to the access log"""
+        if format.startswith("code "):
+            return
+        # Idle keep-alive connections end with a read timeout, which is routine rather than a problem
+        level = logging.DEBUG if format.startswith("Request timed out") else logging.WARNING
+        logging.log(level, "%s %s " + format, self.client_address[0], self.request_id, *args)
+    
+    def log_message(self, format: str, *args):
+        """Send the base handler's messages through logging instead of writing to stderr"""
+        logging.info("%s %s " + format, self.client_address[0], self.request_id, *args)
+    
+    def _metrics_route(self) -> str:
+        """Collapse request paths into a small set of route labels"""
+        path = urlsplit(self.path).path
+        if path in ('/', '/metrics', '/api/chat', '/api/chat/stream', '/api/chat/ws', '/api/chat/batch', '/api/session'):
+            return path
+        if path.startswith('/api/session/'):
+            return '/api/session/:id'
+        return 'static' if self.command == 'GET' else 'other'
+    
+    def end_headers(self):
+        """Add a Server-Timing header with the phases measured so far"""
+        timings = dict(self.timings, total=time.perf_counter() - self.request_started)
+        self.send_header('Server-Timing', ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()))
+        super().end_headers()
+    
+    def send_response(self, code: int, message: Optional[str] = None):
+        """Start a response, closing the connection once it has served MAX_REQUESTS"""
+        super().send_response(code, message)
+        self.status_code = code
+        self.send_header('X-Request-ID', self.request_id)
+        self.requests_served += 1
+        if code == 101:
+            return
+        if self.requests_served >= CONFIG["KEEP_ALIVE"]["MAX_REQUESTS"]:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.1' and not self.close_connection:
+            self.send_header('Keep-Alive', f'timeout={self.timeout}, max={CONFIG["KEEP_ALIVE"]["MAX_REQUESTS"] - self.requests_served}')
+    
     def do_GET(self):
         """Handle GET requests"""
         try:
-            if self.path == '/':
+            path = urlsplit(self.path).path
+            if path == '/':
                 self._serve_homepage()
+            elif path == '/metrics':
+                self._serve_metrics()
+            elif path.startswith('/api/session/'):
+                self._serve_session()
+            elif path == '/api/chat/ws':
+                self._serve_websocket()
             else:
                 self._handle_static_file()
         except Exception as e:
             self._handle_error(500, f"Server error: {str(e)}")
-            logging.error(f"GET request error: {str(e)}")
+            logging.error("GET request error: %s", e)
     
     def do_POST(self):
         """Handle POST requests for API calls"""
         client_ip = self.client_address[0]
         
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = -1
+        max_size = CONFIG["BATCH"]["MAX_REQUEST_SIZE"] if self.path == '/api/chat/batch' else CONFIG["MAX_REQUEST_SIZE"]
+        if content_length < 0 or content_length > max_size:
+            # The unread body would be parsed as the next request, so drop the connection
+            self.close_connection = True
+            self._send_json_response(400, {"error": "Request too large" if content_length > 0 else "Invalid Content-Length"})
+            return
+        # Always consume the body so the next pipelined request starts at the right byte
+        post_data = self.rfile.read(content_length)
+        
         # Check rate limit
-        allowed, message = self.rate_limiter.check_rate_limit(client_ip)
+        allowed, message = self.rate_limiter.check_rate_limit(client_ip, self.path)
         if not allowed:
+            metrics.inc("rate_limit_rejections_total", route=self._metrics_route())
             self._send_json_response(429, {"error": message})
             return
             
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length > CONFIG["MAX_REQUEST_SIZE"]:
-                raise ValueError("Request too large")
-                
-            content_type = self.headers.get('Content-Type', '')
-            
-            if self.path == '/api/chat':
-                if 'application/json' in content_type:
-                    post_data = self.rfile.read(content_length)
-                    data = json.loads(post_data.decode('utf-8'))
-                    user_message = data.get('message', '').strip()
-                else:
-                    post_data = self.rfile.read(content_length)
-                    data = parse_qs(post_data.decode('utf-8'))
-                    user_message = unquote(data.get('message', [''])[0]).strip()
+            if self.path in ('/api/chat', '/api/chat/stream'):
+                user_message, session_id = self._parse_chat_request(post_data)
                 
                 if not user_message:
                     self._send_json_response(400, {"error": "Message is required"})
                     return
                 
-                ai_response = self.ai_client.get_response(user_message)
-                self._send_json_response(200, {"response": ai_response})
+                deadline = self._request_deadline()
+                if self.path == '/api/chat/stream' or 'text/event-stream' in self.headers.get('Accept', ''):
+                    self._stream_chat_response(user_message, deadline, session_id)
+                    return
+                
+                ai_response, headers = self.ai_client.complete(user_message, self.timings, deadline, session_id,
+                                                               self._client_disconnected)
+                self._send_json_response(200, {"response": ai_response}, headers)
+            elif self.path == '/api/chat/batch':
+                self._handle_batch(post_data)
+            elif self.path == '/api/session':
+                if self.ai_client.sessions is None:
+                    self._send_json_response(404, {"error": "Sessions are disabled"})
+                    return
+                self._send_json_response(200, {"session_id": self.ai_client.sessions.create()})
             else:
                 self._send_json_response(404, {"error": "Endpoint not found"})
                 
+        except Overloaded as e:
+            self._send_json_response(503, {"error": str(e)}, {"Retry-After": str(e.retry_after)})
+        except ClientDisconnected:
+            self._client_gone("while waiting for the response")
         except json.JSONDecodeError:
             self._send_json_response(400, {"error": "Invalid JSON"})
         except ValueError as e:
             self._send_json_response(400, {"error": str(e)})
         except Exception as e:
             self._send_json_response(500, {"error": f"Server error: {str(e)}"})
-            logging.error(f"POST request error: {str(e)}")
+            logging.error("POST request error: %s", e)
     
-    def _serve_homepage(self):
-        """Serve the HTML homepage"""
+    def _parse_chat_request(self, post_data: bytes) -> Tuple[str, Optional[str]]:
+        """Extract the chat message and optional session id from a JSON or form-encoded body"""
+        content_type = self.headers.get('Content-Type', '')
+        if 'application/json' in content_type:
+            data = json.loads(post_data.decode('utf-8'))
+            session_id = data.get('session_id') or None
+            if session_id is not None and not isinstance(session_id, str):
+                raise ValueError("session_id must be a string")
+            return data.get('message', '').strip(), session_id
+        data = parse_qs(post_data.decode('utf-8'))
+        return unquote(data.get('message', [''])[0]).strip(), data.get('session_id', [None])[0]
+    
+    def _handle_batch(self, post_data: bytes):
+        """Run {"messages": [...]} upstream and return the results in order, or stream them as NDJSON"""
+        data = json.loads(post_data.decode('utf-8'))
+        messages = data.get('messages') if isinstance(data, dict) else None
+        if not isinstance(messages, list) or not messages:
+            self._send_json_response(400, {"error": "messages must be a non-empty list"})
+            return
+        if len(messages) > CONFIG["BATCH"]["MAX_ITEMS"]:
+            self._send_json_response(400, {"error": f"At most {CONFIG['BATCH']['MAX_ITEMS']} messages per batch"})
+            return
+        
+        # Streamed results start the response before the work is done, so there's no probing the client then
+        disconnected = self._client_closed if data.get('stream') else self._client_disconnected
+        results = self.ai_client.complete_batch(messages, self._request_deadline(), disconnected)
+        if not data.get('stream'):
+            self._send_json_response(200, {"results": list(results)})
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self._send_cors_headers()
+        self._start_chunked_body()
         try:
-            content = self._load_html_template()
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
+            for result in results:
+                self._write_chunk((json.dumps(result) + "\n").encode('utf-8'))
+            self._end_chunked_body()
+        except (BrokenPipeError, ConnectionResetError):
+            results.close()
+            self._client_gone("during batch")
+    
+    def _session_id_from_path(self) -> Optional[str]:
+        """Session id from a /api/session/<id> path"""
+        path = urlsplit(self.path).path
+        if not path.startswith('/api/session/') or self.ai_client.sessions is None:
+            return None
+        return path[len('/api/session/'):] or None
+    
+    def _serve_session(self):
+        """Return a session's stored history"""
+        session_id = self._session_id_from_path()
+        if session_id is None or not self.ai_client.sessions.exists(session_id):
+            self._send_json_response(404, {"error": "Unknown session"})
+            return
+        self._send_json_response(200, {"session_id": session_id, "messages": self.ai_client.sessions.history(session_id)})
+    
+    def do_DELETE(self):
+        """Handle DELETE /api/session/<id>"""
+        session_id = self._session_id_from_path()
+        if session_id is None or not self.ai_client.sessions.delete(session_id):
+            self._send_json_response(404, {"error": "Unknown session"})
+            return
+        self._send_json_response(200, {"deleted": session_id})
+    
+    def _request_deadline(self) -> Optional[float]:
+        """Monotonic deadline from the client's optional X-Request-Timeout header (sec)"""
+        try:
+            return time.monotonic() + float(self.headers['X-Request-Timeout'])
+        except (TypeError, ValueError):
+            return None
+    
+    def _serve_websocket(self):
+        """Upgrade to a WebSocket carrying chat turns as JSON messages until the client goes away"""
+        settings = CONFIG["WEBSOCKET"]
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        if not settings["ENABLED"]:
+            self._send_json_response(404, {"error": "WebSockets are disabled"})
+            return
+        if ('websocket' not in self.headers.get('Upgrade', '').lower()
+                or self.headers.get('Sec-WebSocket-Version') != '13' or not key):
+            self._send_json_response(400, {"error": "Expected a WebSocket upgrade"}, {"Sec-WebSocket-Version": "13"})
+            return
+        # Browsers don't apply CORS to WebSockets, so check the origin ourselves
+        origin = self.headers.get('Origin')
+        if origin and urlsplit(origin).netloc != self.headers.get('Host') \
+                and not any(origin.startswith(allowed) for allowed in CONFIG["ALLOWED_ORIGINS"]):
+            self._send_json_response(403, {"error": "Origin not allowed"})
+            return
+        allowed, message = self.rate_limiter.check_rate_limit(self.client_address[0], self.path)
+        if not allowed:
+            metrics.inc("rate_limit_rejections_total", route=self._metrics_route())
+            self._send_json_response(429, {"error": message})
+            return
+        with HTTPRequestHandler._websocket_lock:
+            if HTTPRequestHandler.websocket_connections >= settings["MAX_CONNECTIONS"]:
+                self._send_json_response(503, {"error": "Too many WebSocket connections"}, {"Retry-After": "5"})
+                return
+            HTTPRequestHandler.websocket_connections += 1
+        
+        self.close_connection = True
+        metrics.inc("websocket_connections")
+        try:
+            self.send_response(101)
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', WebSocket.accept_key(key))
             self.end_headers()
-            self.wfile.write(content.encode('utf-8'))
-        except FileNotFoundError:
-            self._handle_error(404, "File not found")
+            self.connection.settimeout(settings["IDLE_TIMEOUT"])
+            self._websocket_loop(WebSocket(self.rfile, self.wfile, settings["MAX_MESSAGE_SIZE"]))
+        finally:
+            metrics.inc("websocket_connections", -1)
+            with HTTPRequestHandler._websocket_lock:
+                HTTPRequestHandler.websocket_connections -= 1
+    
+    def _websocket_loop(self, ws: WebSocket):
+        """Read client messages, running one chat at a time in a helper thread so cancels get through"""
+        chat: Optional[threading.Thread] = None
+        chat_id = None
+        cancel = Cancellation()
+        finished = threading.Event()  # Set by the chat thread before it reports the chat's outcome
+        try:
+            while True:
+                try:
+                    data = json.loads(ws.receive())
+                except json.JSONDecodeError:
+                    ws.send_json({"type": "error", "error": "Invalid JSON"})
+                    continue
+                if not isinstance(data, dict):
+                    ws.send_json({"type": "error", "error": "Expected a JSON object"})
+                    continue
+                
+                if data.get('type') == 'cancel':
+                    if chat is not None and not finished.is_set() and data.get('id') in (None, chat_id):
+                        cancel.set()
+                    continue
+                if data.get('type') != 'chat':
+                    ws.send_json({"type": "error", "id": data.get('id'), "error": "Unknown message type"})
+                    continue
+                
+                user_message = str(data.get('message') or '').strip()
+                if not user_message:
+                    ws.send_json({"type": "error", "id": data.get('id'), "error": "Message is required"})
+                    continue
+                session_id = data.get('session_id') or None
+                if session_id is not None and not isinstance(session_id, str):
+                    ws.send_json({"type": "error", "id": data.get('id'), "error": "session_id must be a string"})
+                    continue
+                if chat is not None and not finished.is_set():
+                    ws.send_json({"type": "error", "id": data.get('id'), "error": "A chat is already running, cancel it first"})
+                    continue
+                allowed, message = self.rate_limiter.check_rate_limit(self.client_address[0], '/api/chat')
+                if not allowed:
+                    metrics.inc("rate_limit_rejections_total", route=self._metrics_route())
+                    ws.send_json({"type": "error", "id": data.get('id'), "error": message})
+                    continue
+                
+                if chat is not None:
+                    # Only its last frame is left to send, let it go out before the new chat's
+                    chat.join()
+                chat_id = data.get('id')
+                cancel = Cancellation()
+                finished = threading.Event()
+                chat = threading.Thread(target=self._websocket_chat,
+                                        args=(ws, chat_id, user_message, session_id, cancel, finished),
+                                        name="websocket-chat", daemon=True)
+                chat.start()
+        except WebSocketClosed as e:
+            ws.close(e.code)
+        except (socket.timeout, TimeoutError):
+            ws.close(1001)
+        except OSError:
+            pass
+        finally:
+            cancel.set()
+            if chat is not None:
+                chat.join()
+    
+    def _websocket_chat(self, ws: WebSocket, chat_id, user_message: str, session_id: Optional[str],
+                        cancel: Cancellation, finished: threading.Event):
+        """Relay one chat's deltas to the socket until it finishes or is cancelled"""
+        deltas = None
+        outcome = None
+        try:
+            # Passing cancel lets a cancel or a closed socket end the wait for admission or the first delta
+            deltas, headers = self.ai_client.open_stream(user_message, None, session_id, cancel)
+            ws.send_json({"type": "start", "id": chat_id, "cached": headers.get("X-Cache") == "HIT"})
+            for delta in deltas:
+                if cancel.is_set():
+                    break
+                ws.send_json({"type": "delta", "id": chat_id, "delta": delta})
+            if cancel.is_set():
+                metrics.inc("websocket_cancellations_total")
+                outcome = {"type": "cancelled", "id": chat_id}
+            else:
+                outcome = {"type": "done", "id": chat_id}
+        except ClientDisconnected:
+            metrics.inc("websocket_cancellations_total")
+            outcome = {"type": "cancelled", "id": chat_id}
+        except (WebSocketClosed, OSError):
+            cancel.set()
+            metrics.inc("client_disconnects_total", route=self._metrics_route())
+        except Overloaded as e:
+            outcome = self._websocket_error(chat_id, str(e), e.retry_after)
+        except ValueError as e:
+            outcome = self._websocket_error(chat_id, str(e))
+        except Exception as e:
+            logging.error("AI Error: %s", e)
+            outcome = self._websocket_error(chat_id, f"Sorry, I encountered an error processing your request: {str(e)}")
+        finally:
+            if deltas is not None:
+                close_iterator(deltas)
+            # A client may send its next chat as soon as it hears this one ended, so be done by then
+            finished.set()
+        if outcome is not None:
+            try:
+                ws.send_json(outcome)
+            except (WebSocketClosed, OSError):
+                pass
+    
+    @staticmethod
+    def _websocket_error(chat_id, error: str, retry_after: Optional[int] = None) -> Dict:
+        data = {"type": "error", "id": chat_id, "error": error}
+        if retry_after is not None:
+            data["retry_after"] = retry_after
+        return data
+    
+    def _stream_chat_response(self, user_message: str, deadline: Optional[float] = None, session_id: Optional[str] = None):
+        """Relay the AI response as Server-Sent Events, one event per delta"""
+        # Nothing reaches the client before the first delta, so check it's still there until then
+        with ClientWatcher(self._client_disconnected) as cancel:
+            deltas, headers = self.ai_client.open_stream(user_message, deadline, session_id, cancel)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self._send_cors_headers()
+        self._start_chunked_body()
+        self.events_started = True
+        
+        try:
+            with ClientWatcher(self._client_disconnected, cancel):
+                delta = next(deltas, None)
+            while delta is not None:
+                self._send_event({"delta": delta})
+                delta = next(deltas, None)
+            self._send_event({}, event="done")
+            self._end_chunked_body()
+        except ClientDisconnected:
+            self._client_gone("while waiting for the response")
+        except (BrokenPipeError, ConnectionResetError):
+            self._client_gone("during stream")
+        except Exception as e:
+            logging.error("AI Error: %s", e)
+            self._send_event({"error": f"Sorry, I encountered an error processing your request: {str(e)}"}, event="error")
+            self._end_chunked_body()
+        finally:
+            # Stops the upstream call right away if we stopped because the client left
+            close_iterator(deltas)
+    
+    def _client_disconnected(self) -> bool:
+        """True once the client has dropped the connection, for responses that haven't started yet
+        and event streams waiting for their first event.
+        
+        EOF alone doesn't mean the client left, it may have only shut down its sending side and still
+        be waiting for the reply. So a client at EOF is sent something it must skip if it's there, an
+        interim 100 Continue or an event stream comment, which a closed socket answers with a reset
+        the next check sees.
+        """
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            # Nothing to read, or pipelined bytes, mean it's still there
+            if not readable or self.connection.recv(1, socket.MSG_PEEK) != b'':
+                return False
+            if self.eof_probed:
+                # recv keeps reporting EOF after the reset, the error only shows here
+                return self.connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0
+            if self.events_started:
+                self.eof_probed = True
+                self._write_chunk(b": \n\n")
+            elif self.request_version == 'HTTP/1.1':
+                self.eof_probed = True
+                self.connection.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+            return False
+        except (OSError, ValueError):
+            return True
+    
+    def _client_closed(self) -> bool:
+        """True if the client has closed its end of the connection, or at least its sending side.
+        
+        Only for streamed responses, where a client that merely half-closed would be writing to anyway.
+        """
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            # A readable socket with nothing to peek is at EOF; pipelined bytes mean it's still there
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+    
+    def _client_gone(self, during: str):
+        """Record a client that disconnected before its response finished"""
+        self.close_connection = True
+        metrics.inc("client_disconnects_total", route=self._metrics_route())
+        logging.info("Client %s disconnected %s", self.client_address[0], during)
+    
+    def _send_event(self, data: Dict, event: Optional[str] = None):
+        """Write a single Server-Sent Event and flush it to the client"""
+        message = f"event: {event}\n" if event else ""
+        message += f"data: {json.dumps(data)}\n\n"
+        self._write_chunk(message.encode('utf-8'))
+    
+    def _start_chunked_body(self):
+        """Finish the headers of a response whose length isn't known up front"""
+        # HTTP/1.0 clients can't parse chunked bodies, so their response ends by closing instead
+        self.chunked = self.request_version == 'HTTP/1.1'
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+    
+    def _write_chunk(self, data: bytes):
+        if self.chunked:
+            data = f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n"
+        self.wfile.write(data)
+        self.wfile.flush()
+    
+    def _end_chunked_body(self):
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+    
+    def _serve_metrics(self):
+        """Expose the collected metrics for Prometheus to scrape"""
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _serve_homepage(self):
+        """Serve the HTML homepage"""
+        self._serve_asset(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html'))
     
     def _handle_static_file(self):
         """Handle requests for static files"""
+        relative_path = unquote(urlsplit(self.path).path).lstrip('/')
+        
         # Security: Prevent directory traversal
-        if '..' in self.path or self.path.startswith('/'):
+        if '..' in relative_path or os.path.isabs(relative_path):
             self._handle_error(403, "Forbidden")
             return
-            
-        file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.path[1:])
         
-        if not os.path.isfile(file_path):
+        file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), relative_path)
+        if self._get_content_type(file_path) == 'application/octet-stream':
+            # Only known asset types are public, never the server's own source files
             self._handle_error(404, "File not found")
             return
-            
-        content_type = self._get_content_type(file_path)
-        try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
-            self.send_response(200)
-            self.send_header('Content-type', content_type)
+        
+        self._serve_asset(file_path)
+    
+    def _serve_asset(self, file_path: str):
+        """Send a static file, answering conditional GETs with 304 and preferring gzip"""
+        asset = static_files.get(file_path, self._get_content_type(file_path)) if os.path.isfile(file_path) else None
+        if asset is None:
+            self._handle_error(404, "File not found")
+            return
+        
+        if self._is_not_modified(asset):
+            self.send_response(304)
+            self.send_header('ETag', asset.etag)
+            self.send_header('Last-Modified', asset.last_modified)
             self.end_headers()
+            return
+        
+        use_gzip = asset.gzip_content is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        content = asset.gzip_content if use_gzip else asset.content
+        etag = asset.gzip_etag if use_gzip else asset.etag
+        
+        self.send_response(200)
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(content) if content is not None else asset.size))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        
+        if content is not None:
             self.wfile.write(content)
+            return
+        try:
+            # Large files go from the page cache to the socket without passing through Python
+            with open(file_path, 'rb') as f:
+                self.connection.sendfile(f, 0, asset.size)
         except Exception as e:
-            self._handle_error(500, f"Error reading file: {str(e)}")
+            self.close_connection = True
+            logging.error("Error sending file %s: %s", file_path, e)
     
-    def _send_json_response(self, status_code: int, data: Dict):
+    def _is_not_modified(self, asset: StaticAsset) -> bool:
+        """Check the request's validators against the asset"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return asset.etag in tags or asset.gzip_etag in tags or '*' in tags
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= asset.mtime_ns // 1_000_000_000
+            except (TypeError, ValueError):
+                return False
+        return False
+    
+    def _send_json_response(self, status_code: int, data: Dict, headers: Optional[Dict[str, str]] = None):
         """Send a JSON response"""
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json')
-        
-        # Handle CORS
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self._send_cors_headers()
+        body = json.dumps(data).encode('utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _send_cors_headers(self):
+        """Allow cross-origin calls from the configured origins"""
         origin = self.headers.get('Origin')
         if origin and any(origin.startswith(allowed) for allowed in CONFIG["ALLOWED_ORIGINS"]):
             self.send_header('Access-Control-Allow-Origin', origin)
-            self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+            self.send_header('Access-Control-Allow-Methods', 'POST, GET, DELETE, OPTIONS')
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
-    
-    def _load_html_template(self) -> str:
-        """Load HTML template file"""
-        html_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html')
-        with open(html_file_path, 'r', encoding='utf-8') as f:
-            return f.read()
     
     def _get_content_type(self, file_path: str) -> str:
         """Determine content type based on file extension"""
@@ -271,28 +2195,232 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
     def _handle_error(self, code: int, message: str):
         """Handle HTTP errors"""
         self.send_error(code, message)
-        logging.error(f"HTTP {code}: {message}")
+        if code >= 500:
+            logging.error("HTTP %d for request %s: %s", code, self.request_id, message)
     
     def do_OPTIONS(self):
         """Handle OPTIONS requests for CORS preflight"""
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'POST, GET, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-def run_server(port: int = CONFIG["PORT"]):
+def pool_size() -> int:
+    """Worker threads for "pool" mode: WORKER_THREADS for HTTP plus one per allowed WebSocket"""
+    websocket = CONFIG["WEBSOCKET"]
+    return CONFIG["WORKER_THREADS"] + (websocket["MAX_CONNECTIONS"] if websocket["ENABLED"] else 0)
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """HTTP server that hands each connection to a bounded pool of worker threads"""
+    # Written straight from the accept loop when the pending queue is full
+    BUSY_BODY = b'{"error": "Server busy, try again"}'
+    BUSY_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\nRetry-After: 1\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(BUSY_BODY)) + BUSY_BODY
+    
+    def __init__(self, server_address, handler_class, bind_and_activate: bool = True,
+                 max_workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.max_workers = max_workers or pool_size()
+        # Accepted connections waiting for a worker, bounded so the pool size really limits what's taken on
+        self.pending: "queue.Queue[Optional[Tuple[socket.socket, Tuple]]]" = queue.Queue(
+            max_pending if max_pending is not None else CONFIG["MAX_PENDING_CONNECTIONS"])
+        # Daemon threads like ThreadingHTTPServer's, so open connections don't hold up shutdown
+        self.workers: List[threading.Thread] = []
+        self.connections = 0  # Accepted and not yet closed, queued ones included
+        self.idle_connections: Dict[socket.socket, None] = {}  # Keep-alive sockets between requests, oldest first
+        self._lock = threading.Lock()
+        super().__init__(server_address, handler_class, bind_and_activate)
+    
+    def process_request(self, request, client_address):
+        """Queue the connection for a worker instead of serving it inline"""
+        with self._lock:
+            self.connections += 1
+            if len(self.workers) < min(self.connections, self.max_workers):
+                worker = threading.Thread(target=self._worker, name=f"http-worker-{len(self.workers)}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            reclaim = None
+            if self.connections > self.max_workers and self.idle_connections:
+                reclaim = next(iter(self.idle_connections))
+                del self.idle_connections[reclaim]
+        if reclaim is not None:
+            # The worker blocked reading that connection's next request sees EOF and closes it
+            try:
+                reclaim.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            with self._lock:
+                self.connections -= 1
+            metrics.inc("connections_rejected_total")
+            try:
+                request.sendall(self.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+    
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            self._serve_connection(*item)
+    
+    def _serve_connection(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            with self._lock:
+                self.connections -= 1
+                self.idle_connections.pop(request, None)
+    
+    def connection_idle(self, connection: socket.socket) -> bool:
+        """Note a keep-alive connection waiting for its next request; False if connections are queued for a worker"""
+        with self._lock:
+            if self.connections > self.max_workers:
+                return False
+            self.idle_connections[connection] = None
+            return True
+    
+    def connection_busy(self, connection: socket.socket):
+        with self._lock:
+            self.idle_connections.pop(connection, None)
+    
+    def server_close(self):
+        super().server_close()
+        # Drop connections nobody has started on, then let idle workers exit
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        for _ in self.workers:
+            try:
+                self.pending.put_nowait(None)
+            except queue.Full:
+                break
+
+def create_server(server_address: Tuple[str, int], handler_class, mode: str = CONFIG["SERVER_MODE"],
+                  reuse_port: bool = False) -> HTTPServer:
+    """Build the HTTP server for the selected serving mode"""
+    if mode == "single":
+        httpd = HTTPServer(server_address, handler_class, bind_and_activate=False)
+    elif mode == "thread":
+        httpd = ThreadingHTTPServer(server_address, handler_class, bind_and_activate=False)
+    elif mode == "pool":
+        httpd = PooledHTTPServer(server_address, handler_class, bind_and_activate=False)
+    else:
+        raise ValueError(f"Unknown server mode: {mode}")
+    
+    try:
+        if reuse_port:
+            # Every worker binds its own socket and the kernel spreads connections between them
+            httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        httpd.server_bind()
+        httpd.server_activate()
+    except Exception:
+        httpd.server_close()
+        raise
+    return httpd
+
+def run_workers(port: int = CONFIG["PORT"], workers: int = CONFIG["WORKERS"], mode: str = CONFIG["SERVER_MODE"],
+                prewarm: bool = CONFIG["PREWARM"]):
+    """Pre-fork worker processes on one port and restart any that die"""
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("Multiple workers need os.fork and SO_REUSEPORT")
+    
+    state_dir = tempfile.mkdtemp(prefix="piton-server-")
+    authkey = os.urandom(16)
+    state = StateManager(address=os.path.join(state_dir, 'state.sock'), authkey=authkey)
+    state.start()
+    
+    children: Dict[int, float] = {}
+    stopping = False
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                worker_state = StateManager(address=state.address, authkey=authkey)
+                worker_state.connect()
+                ClientRegistry.use_shared_state(worker_state)
+                run_server(port, mode, prewarm, reuse_port=True)
+            except BaseException as e:
+                logging.error(f"Worker {os.getpid()} crashed: {str(e)}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        spawn()
+    logging.info(f"Supervisor {os.getpid()} started {workers} workers on port {port}")
+    
+    try:
+        while not stopping:
+            time.sleep(0.5)
+            for pid, started in list(children.items()):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if not done:
+                    continue
+                # Reaped, so forget it even when stopping or the shutdown wait below would wait on it again
+                del children[pid]
+                if stopping:
+                    continue
+                logging.warning(f"Worker {pid} exited with status {status}, restarting")
+                if time.monotonic() - started < 1:
+                    # Don't spin if workers die straight after starting
+                    time.sleep(1)
+                spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("Server shutting down")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        state.shutdown()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+def run_server(port: int = CONFIG["PORT"], mode: str = CONFIG["SERVER_MODE"], prewarm: bool = CONFIG["PREWARM"],
+               reuse_port: bool = False):
     """Run the HTTP server"""
+    ai_client = ClientRegistry.ai_client()
+    rate_limiter = ClientRegistry.rate_limiter()
+    if prewarm:
+        ai_client.prewarm()
+    
     server_address = ('', port)
-    httpd = HTTPServer(
+    httpd = create_server(
         server_address, 
         lambda *args: HTTPRequestHandler(
             *args, 
-            ai_client=AIClient(),
-            rate_limiter=RateLimiter()
-        )
+            ai_client=ai_client,
+            rate_limiter=rate_limiter
+        ),
+        mode,
+        reuse_port
     )
-    logging.info(f'Starting server on port {port}')
+    logging.info(f'Starting server on port {port} ({mode} mode, pid {os.getpid()})')
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -301,4 +2429,7 @@ def run_server(port: int = CONFIG["PORT"]):
         httpd.server_close()
 
 if __name__ == '__main__':
-    run_server()
\ No newline at end of file
+    if CONFIG["WORKERS"] > 1:
+        run_workers()
+    else:
+        run_server()
\ No newline at end of file